@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+End-to-end crawl benchmark: crawls a synthetic site served locally by mock_site.py with crawler.py in a subprocess,
+through its real HTTP stack, and reports the pages per second, the CPU time of the crawler and its workers, and the
+peak RSS of the largest of those processes. The results are printed next to the previous run's with the same
+parameters and saved to benchmarks/results.jsonl. Exits with status 1 if any regressed by more than --tolerance.
+
+Run from the project root: python benchmarks/crawl.py --products 2000 --fanout 10 --latency 0.01 -- -w 16
+"""
+import os
+import sys
+import json
+import argparse
+import resource
+import tempfile
+import subprocess
+from time import perf_counter
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, PROJECT_ROOT)
+
+from history import report
+import mock_site
+
+
+def run_crawl(site, depth, crawler_args):
+    """Crawls the site with crawler.py
+
+    Args:
+        site (mock_site.MockSite): The site, served while the crawl runs
+        depth (int): The crawl depth
+        crawler_args (list): More command line arguments for crawler.py
+
+    Returns:
+        dict: The seconds, pages per second, CPU seconds and peak RSS megabytes
+    """
+    server = site.serve()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            metrics_file = os.path.join(directory, 'metrics.json')
+            start = perf_counter()
+            subprocess.check_call([sys.executable, os.path.join(PROJECT_ROOT, 'crawler.py'), '-d', str(depth),
+                                   '-o', os.path.join(directory, 'output.csv'), '--metrics', metrics_file,
+                                   '--base-url', server.base_url, '--log-level', 'WARNING'] + crawler_args + ['/'])
+            elapsed = perf_counter() - start
+            with open(metrics_file) as metrics:
+                metrics = json.load(metrics)
+    finally:
+        server.shutdown()
+        server.server_close()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    pages = metrics['counters'].get('pages', 0)
+    print('Crawled {} pages and found {} products.'.format(pages, metrics['counters'].get('products', 0)))
+    return {'seconds': elapsed,
+            'pages_per_second': pages / elapsed,
+            'cpu_seconds': after.ru_utime + after.ru_stime - usage.ru_utime - usage.ru_stime,
+            # Kilobytes on Linux; the largest process the crawl ran, not their sum
+            'peak_rss_mb': after.ru_maxrss / 1024.0}
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmarks a whole crawl of a local synthetic site.')
+    parser.add_argument('--products', default=1000, type=int, help='The number of product pages of the site.')
+    parser.add_argument('--categories', default=20, type=int, help='The number of categories of the site.')
+    parser.add_argument('--fanout', default=10, type=int, help='The number of product links on each page.')
+    parser.add_argument('--latency', default=0.0, type=float, help='The mean seconds the site takes to answer.')
+    parser.add_argument('--latency-distribution', default='constant', choices=mock_site.LATENCY_DISTRIBUTIONS)
+    parser.add_argument('--error-rate', default=0.0, type=float, help='The fraction of 503 answers.')
+    parser.add_argument('--no-embedded', action='store_true',
+                        help='Don\'t embed the product data as JSON in the product pages, so every one is parsed.')
+    parser.add_argument('-d', '--depth', default=5, type=int)
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='The change, relative to the previous run, reported as a regression.')
+    parser.add_argument('--no-save', action='store_true', help='Don\'t save the results.')
+    parser.add_argument('crawler_args', nargs=argparse.REMAINDER,
+                        help='More arguments for crawler.py, after --, like -- -e asyncio -c 200')
+    config = parser.parse_args(args)
+    crawler_args = [arg for arg in config.crawler_args if arg != '--']
+    site = mock_site.MockSite(config.products, config.categories, config.fanout, config.latency,
+                              config.latency_distribution, config.error_rate, embedded=not config.no_embedded)
+    measurements = run_crawl(site, config.depth, crawler_args)
+    params = {'products': config.products, 'categories': config.categories, 'fanout': config.fanout,
+              'latency': config.latency, 'latency_distribution': config.latency_distribution,
+              'error_rate': config.error_rate, 'embedded': not config.no_embedded, 'depth': config.depth,
+              'crawler_args': crawler_args}
+    print('Crawl of {products} products, fan-out {fanout}, {latency_distribution} latency {latency}s, '
+          'error rate {error_rate}, depth {depth} {crawler_args}:'.format(**params))
+    regressed = report('crawl', params, measurements, higher_is_better=('pages_per_second',),
+                       tolerance=config.tolerance, save=not config.no_save)
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
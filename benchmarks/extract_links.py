@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Compares the time extract_links and extract_links_fast take on the bundled test pages.
+
+Run from the project root: python benchmarks/extract_links.py
+"""
+import os
+import glob
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crawler
+from tests import TEST_FILE_PATH
+
+
+def main(number=50):
+    print('{:<80} {:>10} {:>10} {:>8}'.format('page', 'dom (ms)', 'fast (ms)', 'speedup'))
+    for path in sorted(glob.glob(os.path.join(TEST_FILE_PATH, '*.html'))):
+        filename = os.path.basename(path)
+        html = open(path).read()
+        assert crawler.extract_links(html) == crawler.extract_links_fast(html), filename
+        dom = min(timeit.repeat(lambda: crawler.extract_links(html), number=number, repeat=3)) / number * 1000
+        fast = min(timeit.repeat(lambda: crawler.extract_links_fast(html), number=number, repeat=3)) / number * 1000
+        print('{:<80} {:>10.3f} {:>10.3f} {:>7.1f}x'.format(filename, dom, fast, dom / fast))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+"""
+Keeps the benchmark results in a JSON Lines file and compares each run with the previous one, to catch regressions.
+"""
+import os
+import json
+import subprocess
+from datetime import datetime
+
+RESULTS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results.jsonl')
+
+
+def git_revision():
+    """Returns the short hash of the checked out commit, with a + if the tree has changes, or None outside git"""
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL)
+        changed = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'],
+                                          stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return revision.decode().strip() + ('+' if changed.strip() else '')
+
+
+def previous_result(name, params, filename=RESULTS_FILE):
+    """Returns the last result saved for the benchmark with the same parameters, or None"""
+    if not os.path.exists(filename):
+        return None
+    last = None
+    with open(filename, encoding='utf-8') as results:
+        for line in results:
+            result = json.loads(line)
+            if result['benchmark'] == name and result['params'] == params:
+                last = result
+    return last
+
+
+def save_result(name, params, measurements, filename=RESULTS_FILE):
+    """Appends a result to the results file
+
+    Args:
+        name (str): The benchmark name
+        params (dict): The parameters of the run; only runs with the same parameters are compared
+        measurements (dict): The measured values
+
+    Returns:
+        dict: The result saved
+    """
+    result = {'benchmark': name, 'params': params, 'measurements': measurements,
+              'revision': git_revision(), 'date': datetime.now().isoformat(timespec='seconds')}
+    with open(filename, 'a', encoding='utf-8') as results:
+        results.write(json.dumps(result, sort_keys=True) + '\n')
+    return result
+
+
+def compare(previous, current, higher_is_better=(), tolerance=0.1):
+    """Compares the measurements of two runs
+
+    Args:
+        previous (dict): The previous measurements
+        current (dict): The current measurements
+        higher_is_better (iterable): The measurements where higher is better, like throughputs; for the others,
+            like times and memory, lower is better
+        tolerance (float): The relative change tolerated before a measurement counts as a regression
+
+    Returns:
+        list: (name, previous, current, change, regressed) for each measurement in both runs
+    """
+    rows = []
+    for name in sorted(set(previous) & set(current)):
+        if not previous[name]:
+            continue
+        change = (current[name] - previous[name]) / previous[name]
+        regressed = -change > tolerance if name in higher_is_better else change > tolerance
+        rows.append((name, previous[name], current[name], change, regressed))
+    return rows
+
+
+def report(name, params, measurements, higher_is_better=(), tolerance=0.1, save=True):
+    """Prints the measurements next to the previous run's, saves them and returns whether any regressed"""
+    previous = previous_result(name, params)
+    if previous is None:
+        for measurement, value in sorted(measurements.items()):
+            print('  {:<44} {:>12.4g}'.format(measurement, value))
+        regressed = False
+    else:
+        print('  {:<44} {:>12} {:>12} {:>8}   (previous: {} {})'.format(
+            '', 'previous', 'current', 'change', previous['revision'], previous['date']))
+        rows = compare(previous['measurements'], measurements, higher_is_better, tolerance)
+        for measurement, before, after, change, worse in rows:
+            print('  {:<44} {:>12.4g} {:>12.4g} {:>+7.1%}{}'.format(measurement, before, after, change,
+                                                                   '   REGRESSION' if worse else ''))
+        regressed = any(row[4] for row in rows)
+    if save:
+        save_result(name, params, measurements)
+    return regressed
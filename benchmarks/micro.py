@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks of the crawler's hot paths: parsing and extracting from the bundled test pages, and taking tasks out
+of the frontier. Prints the microseconds per call of each, next to the previous run's, and saves them to
+benchmarks/results.jsonl. Exits with status 1 if any got more than --tolerance slower.
+
+Run from the project root: python benchmarks/micro.py
+"""
+import os
+import sys
+import glob
+import timeit
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import crawler
+from tests import TEST_FILE_PATH
+from history import report
+
+PRODUCT_PAGES = ('hypnose-eau-de-toilette-lancome-perfume-feminino.html',
+                 'lady-million-eau-my-gold-eau-de-toilette-paco-rabanne-perfume-feminino.html')
+FRONTIER_SIZE = 10000
+SCHEMA_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schemas', 'product.json')
+
+
+def best_time(function, number, repeat=5):
+    """Returns the microseconds per call of the fastest of repeat runs of number calls"""
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+
+def page_benchmarks(number):
+    """Times the extractors on each bundled page
+
+    Returns:
+        dict: The microseconds per call, keyed by function:page
+    """
+    measurements = {}
+    schema = crawler.load_schema(SCHEMA_FILE)
+    for path in sorted(glob.glob(os.path.join(TEST_FILE_PATH, '*.html'))):
+        page = os.path.splitext(os.path.basename(path))[0].split('-')[0]
+        html = open(path).read()
+        tree = crawler.parse_page(html)
+        measurements['parse_page:' + page] = best_time(lambda: crawler.parse_page(html), number)
+        measurements['extract_links:' + page] = best_time(lambda: crawler.extract_links(tree), number)
+        measurements['extract_links_fast:' + page] = best_time(lambda: crawler.extract_links_fast(html), number)
+        measurements['page_digest:' + page] = best_time(lambda: crawler.page_digest(html, None), number)
+        if os.path.basename(path) in PRODUCT_PAGES:
+            measurements['extract_values:' + page] = best_time(lambda: crawler.extract_values(tree), number)
+            measurements['extract_values_embedded:' + page] = best_time(
+                lambda: crawler.extract_values_embedded(html), number)
+            measurements['schema:' + page] = best_time(lambda: schema.extract(html), number)
+            measurements['extract_product_name:' + page] = best_time(lambda: crawler.extract_product_name(tree),
+                                                                     number)
+    return measurements
+
+
+def frontier_benchmarks(number):
+    """Times pushing FRONTIER_SIZE URLs into a frontier and taking them out with generate_tasks
+
+    Returns:
+        dict: The microseconds per URL of each
+    """
+    urls = ['http://www.epocacosmeticos.com.br/produto_{}/p'.format(n) for n in range(FRONTIER_SIZE)]
+
+    def fill():
+        frontier = crawler.Frontier(1)
+        for url in urls:
+            frontier.push(url, 1)
+        return frontier
+
+    def drain():
+        for task in crawler.generate_tasks(frontiers.pop(), FRONTIER_SIZE):
+            pass
+
+    push = best_time(fill, number) / FRONTIER_SIZE
+    frontiers = [fill() for n in range(number * 5)]
+    generate = best_time(drain, number) / FRONTIER_SIZE
+    return {'frontier_push': push, 'generate_tasks': generate}
+
+
+def seen_store_benchmarks():
+    """Times adding FRONTIER_SIZE new URLs to each seen store, adding them again, and again, like the links on every
+    page
+
+    Returns:
+        dict: The microseconds per URL of each
+    """
+    urls = ['http://www.epocacosmeticos.com.br/produto_{}/p'.format(n) for n in range(FRONTIER_SIZE)]
+    measurements = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for store in ('memory', 'disk', 'bloom'):
+            filename = os.path.join(directory, store + '.seen')
+            seen = {'memory': crawler.SeenSet,
+                    'disk': lambda: crawler.DiskSeenSet(filename, temporary=True),
+                    'bloom': lambda: crawler.BloomSeenSet(filename, temporary=True)}[store]()
+            for phase in ('new', 'again', 'recent'):
+                start = timeit.default_timer()
+                for url in urls:
+                    seen.add(url, 1, queue=True)
+                measurements['seen_{}_{}'.format(store, phase)] = (timeit.default_timer() - start) / FRONTIER_SIZE * 1e6
+            seen.close()
+    return measurements
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the extraction and scheduling hot paths.')
+    parser.add_argument('-n', '--number', default=20, type=int, help='The calls per timing run.')
+    parser.add_argument('--tolerance', default=0.1, type=float,
+                        help='The slowdown, relative to the previous run, reported as a regression.')
+    parser.add_argument('--no-save', action='store_true', help='Don\'t save the results.')
+    config = parser.parse_args(args)
+    measurements = page_benchmarks(config.number)
+    measurements.update(frontier_benchmarks(config.number))
+    measurements.update(seen_store_benchmarks())
+    print('Microseconds per call:')
+    regressed = report('micro', {'number': config.number}, measurements, tolerance=config.tolerance,
+                       save=not config.no_save)
+    return 1 if regressed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,290 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+A local, synthetic copy of www.epocacosmeticos.com.br for load-testing the crawler offline, over real HTTP.
+
+The site has a home page, category pages listing their products over numbered pages and product pages linking to
+related products, all rendered from test_files/mock_page.html. It is generated from a seed, so every run serves the
+same site. Answers can be delayed by a latency distribution, fail with 5xx or 429 errors at given rates, and some links
+point to removed products, which redirect to the home page with ProductLinkNotFound as the real site does. It also
+serves a /sitemap.xml of the products and a /robots.txt. Like the real ones, the product pages embed their data as
+JSON, for the crawler's embedded extractor.
+
+Usage:
+
+`python mock_site.py --port 8000 --products 10000 --categories 50 --latency 0.05 --error-rate 0.01`
+
+`python crawler.py --base-url http://127.0.0.1:8000 -d 5 -o output.csv /`
+"""
+import os
+import sys
+import gzip
+import json
+import random
+import argparse
+import threading
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+TEMPLATE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'test_files', 'mock_page.html')
+TEMPLATE_LINK = '<a href="http://www.epocacosmeticos.com.br/{}"></a>\n'
+LATENCY_DISTRIBUTIONS = ('constant', 'uniform', 'exponential')
+
+
+class MockSite:
+    """The pages of the synthetic site and how it answers.
+
+    Product n belongs to category n % categories. Each category lists its products, fanout per page, linking to the
+    next page with ?PageNumber= and to another category; each product page links to its category and to fanout - 1
+    related products, some of which may have been removed. The home page links to every category, so every product
+    is reachable.
+
+    Args:
+        products (int): The number of product pages, /produto-<n>/p
+        categories (int): The number of categories, /categoria-<n>
+        fanout (int): The number of product links on each page
+        latency (float): The mean seconds each answer is delayed by
+        latency_distribution (str): constant, uniform between 0 and twice the mean, or exponential
+        error_rate (float): The fraction of the answers that are a 503 Service Unavailable
+        throttle_rate (float): The fraction of the answers that are a 429 Too Many Requests, with a Retry-After
+        removed_rate (float): The fraction of the related product links that point to a removed product
+        seed (int): The seed of the links; the latencies and errors are random
+        embedded (bool): If the product pages embed the VTEX skuJson_0 and vtex.events.addData objects
+    """
+    def __init__(self, products=1000, categories=20, fanout=10, latency=0.0, latency_distribution='constant',
+                 error_rate=0.0, throttle_rate=0.0, removed_rate=0.0, seed=0, embedded=True):
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError('Unknown latency distribution {}'.format(latency_distribution))
+        self.products = products
+        self.categories = max(min(categories, products), 1)
+        self.fanout = max(fanout, 1)
+        self.latency = latency
+        self.latency_distribution = latency_distribution
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.removed_rate = removed_rate
+        self.seed = seed
+        self.embedded = embedded
+        self.random = random.Random()
+        template = open(TEMPLATE_FILE, encoding='utf-8').read()
+        # The template has three link lines; the pages get one per link instead
+        self.head, _, tail = template.partition(TEMPLATE_LINK)
+        self.tail = tail.replace(TEMPLATE_LINK, '')
+        self.served = 0
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Returns the seconds the next answer is delayed by"""
+        if not self.latency:
+            return 0.0
+        if self.latency_distribution == 'uniform':
+            return self.random.uniform(0, 2 * self.latency)
+        if self.latency_distribution == 'exponential':
+            return self.random.expovariate(1 / self.latency)
+        return self.latency
+
+    def failure(self):
+        """Returns the status of an injected error for the next answer, or None"""
+        draw = self.random.random()
+        if draw < self.error_rate:
+            return 503
+        if draw < self.error_rate + self.throttle_rate:
+            return 429
+        return None
+
+    def product_link(self, n, link_random):
+        if link_random.random() < self.removed_rate:
+            return 'produto-removido-{}/p'.format(n)
+        return 'produto-{}/p'.format(n)
+
+    def category_size(self, category):
+        return len(range(category, self.products, self.categories))
+
+    def links(self, path, query):
+        """Returns the links on the page at path, or None if there's no such page"""
+        if path == '/':
+            return ['categoria-{}'.format(n) for n in range(self.categories)]
+        name = path.strip('/')
+        if name.startswith('categoria-') and name[len('categoria-'):].isdigit():
+            category = int(name[len('categoria-'):])
+            page = query.get('PageNumber', ['1'])[0]
+            if category >= self.categories or not page.isdigit() or int(page) < 1:
+                return None
+            page = int(page)
+            first = (page - 1) * self.fanout
+            if first and first >= self.category_size(category):
+                return None
+            link_random = random.Random('{}:{}:{}'.format(self.seed, name, page))
+            listed = range(category, self.products, self.categories)[first:first + self.fanout]
+            links = ['produto-{}/p'.format(n) for n in listed]
+            if first + self.fanout < self.category_size(category):
+                links.append('{}?PageNumber={}'.format(name, page + 1))
+            links.append('categoria-{}'.format(link_random.randrange(self.categories)))
+            return links
+        if name.startswith('produto-') and name.endswith('/p') and name[len('produto-'):-2].isdigit():
+            product = int(name[len('produto-'):-2])
+            if product >= self.products:
+                return None
+            link_random = random.Random('{}:{}'.format(self.seed, name))
+            related = [link_random.randrange(self.products) for _ in range(self.fanout - 1)]
+            return ['categoria-{}'.format(product % self.categories)] + [self.product_link(n, link_random)
+                                                                         for n in related]
+        return None
+
+    def product_data(self, product, product_name, title):
+        """Returns the script with the VTEX objects of a product page: one SKU, priced from the product number"""
+        price = 1990 + product * 37 % 50000
+        sku_json = {'productId': product, 'name': product_name, 'available': product % 10 != 0,
+                    'skus': [{'sku': product, 'skuname': product_name, 'available': product % 10 != 0,
+                              'listPrice': price + 1000 if product % 3 == 0 else 0, 'bestPrice': price}]}
+        product_data = {'pageCategory': 'Product', 'pageTitle': title, 'productId': product,
+                        'productName': product_name}
+        return '<script>var skuJson_0 = {};\nvtex.events.addData({});</script>\n'.format(
+            json.dumps(sku_json, ensure_ascii=False), json.dumps(product_data, ensure_ascii=False))
+
+    def render(self, path, query, base_url):
+        """Returns the HTML of the page at path, or None if there's no such page
+
+        Args:
+            path (str): The path of the page
+            query (dict): The parsed query string
+            base_url (str): The scheme and host the site is served at, used in the absolute links
+        """
+        links = self.links(path, query)
+        if links is None:
+            return None
+        name = path.strip('/')
+        script = ''
+        if path.endswith('/p'):
+            title = 'Produto {} - Época Cosméticos'.format(name[len('produto-'):-2])
+            product_name = 'Produto {}'.format(name[len('produto-'):-2])
+            if self.embedded:
+                script = self.product_data(int(name[len('produto-'):-2]), product_name, title)
+        else:
+            title = '{} - Época Cosméticos'.format(name.replace('-', ' ').title() or 'Home')
+            product_name = ''
+        return (self.head.format(title, product_name) + script +
+                ''.join('<a href="{}/{}"></a>\n'.format(base_url, link) for link in links) +
+                self.tail)
+
+    def sitemap(self, base_url):
+        """Returns the sitemap listing every product page"""
+        return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<urlset xmlns="http://www.sitemaps.org/schemas/sitemap/0.9">\n' +
+                ''.join('<url><loc>{}/produto-{}/p</loc><lastmod>2016-05-01</lastmod></url>\n'.format(base_url, n)
+                        for n in range(self.products)) +
+                '</urlset>\n')
+
+    def serve(self, port=0, host='127.0.0.1'):
+        """Serves the site from a background thread
+
+        Args:
+            port (int): The port to listen to, any free port by default
+            host (str): The address to listen at
+
+        Returns:
+            HTTPServer: The running server. Its base_url is the URL to crawl and shutdown() stops it.
+        """
+        handler = type('MockSiteHandler', (MockSiteHandler,), {'site': self})
+        server = ThreadedHTTPServer((host, port), handler)
+        server.base_url = 'http://{}:{}'.format(host, server.server_port)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+class MockSiteHandler(BaseHTTPRequestHandler):
+    """Answers the requests for the pages of a MockSite, keeping the connections alive and gzipping the pages for the
+    clients that accept it"""
+    protocol_version = 'HTTP/1.1'
+    # The headers and the body go out in separate writes; with Nagle's algorithm the body would wait for the
+    # client's delayed ACK of the headers, adding 40ms to every answer
+    disable_nagle_algorithm = True
+    site = None
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        base_url = 'http://' + (self.headers.get('Host') or '{}:{}'.format(*self.server.server_address[:2]))
+        with self.site._lock:
+            self.site.served += 1
+        sleep(self.site.delay())
+        status = self.site.failure()
+        if status:
+            self.send_body(status, b'', {'Retry-After': '1'} if status == 429 else {})
+            return
+        if parts.path == '/robots.txt':
+            self.send_body(200, 'User-agent: *\nDisallow: /checkout\n'.encode('utf-8'), content_type='text/plain')
+            return
+        if parts.path == '/sitemap.xml':
+            self.send_body(200, self.site.sitemap(base_url).encode('utf-8'), content_type='application/xml')
+            return
+        page = self.site.render(parts.path, parse_qs(parts.query), base_url)
+        if page is None:
+            # Like the real site, unknown and removed products redirect to the home page
+            self.send_body(302, b'', {'Location': '{}/?ProductLinkNotFound={}'.format(base_url,
+                                                                                      parts.path.strip('/'))})
+            return
+        self.send_body(200, page.encode('utf-8'))
+
+    def send_body(self, status, body, headers=None, content_type='text/html; charset=utf-8'):
+        self.send_response(status)
+        if body:
+            self.send_header('Content-Type', content_type)
+            if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                body = gzip.compress(body, 1)
+                self.send_header('Content-Encoding', 'gzip')
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description='Serves a synthetic copy of www.epocacosmeticos.com.br.')
+    parser.add_argument('--host', default='127.0.0.1', type=str)
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--products', default=1000, type=int, help='The number of product pages.')
+    parser.add_argument('--categories', default=20, type=int, help='The number of categories.')
+    parser.add_argument('--fanout', default=10, type=int, help='The number of product links on each page.')
+    parser.add_argument('--latency', default=0.0, type=float, help='The mean seconds each answer is delayed by.')
+    parser.add_argument('--latency-distribution', default='constant', choices=LATENCY_DISTRIBUTIONS)
+    parser.add_argument('--error-rate', default=0.0, type=float,
+                        help='The fraction of the answers that are a 503 Service Unavailable.')
+    parser.add_argument('--throttle-rate', default=0.0, type=float,
+                        help='The fraction of the answers that are a 429 Too Many Requests.')
+    parser.add_argument('--removed-rate', default=0.0, type=float,
+                        help='The fraction of the related product links that point to removed products, which '
+                             'redirect.')
+    parser.add_argument('--seed', default=0, type=int, help='The seed the site is generated from.')
+    parser.add_argument('--no-embedded', action='store_true',
+                        help='Don\'t embed the product data as JSON, so the crawler parses every product page.')
+    return parser.parse_args(args)
+
+
+def main(args):
+    config = parse_args(args)
+    site = MockSite(config.products, config.categories, config.fanout, config.latency, config.latency_distribution,
+                    config.error_rate, config.throttle_rate, config.removed_rate, config.seed,
+                    not config.no_embedded)
+    server = site.serve(config.port, config.host)
+    print('Serving {} products in {} categories. Crawl it with: crawler.py --base-url {} -o output.csv /'.format(
+        site.products, site.categories, server.base_url))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+    print('Served {} requests.'.format(site.served))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
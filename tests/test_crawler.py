@@ -1,7 +1,21 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 import os
+import glob
+import csv
+import gzip
+import json
+import time
+import pstats
+import socket
+import asyncio
+import tempfile
 import unittest
+import threading
+from unittest.mock import patch
+from email.utils import formatdate
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
 import lxml
 
 import crawler
@@ -71,6 +85,142 @@ class TestExtractValues(unittest.TestCase):
         self.assertRaises(IndexError, crawler.extract_values, html)
 
 
+class TestExtractValuesEmbedded(unittest.TestCase):
+    """Tests the extraction of the values from the JSON embedded in the product pages"""
+    product_pages = ('hypnose-eau-de-toilette-lancome-perfume-feminino.html',
+                     'lady-million-eau-my-gold-eau-de-toilette-paco-rabanne-perfume-feminino.html')
+
+    def test_same_values_as_the_dom(self):
+        for filename in self.product_pages:
+            html = open(os.path.join(TEST_FILE_PATH, filename)).read()
+            values = crawler.extract_values_embedded(html)
+            self.assertEqual(crawler.extract_values(html),
+                             {'product_name': values['product_name'], 'page_title': values['page_title']})
+
+    def test_prices(self):
+        html = open(os.path.join(TEST_FILE_PATH, self.product_pages[1])).read()
+        values = crawler.extract_values_embedded(html)
+        self.assertEqual({'sku': '11446', 'price': 139.3, 'list_price': 199.0, 'available': True},
+                         {field: values[field] for field in crawler.PRICE_FIELDS})
+
+    def test_pages_without_product_data(self):
+        for filename in ('home_page.html', 'prod_index_cabelos.html', 'mock_page.html'):
+            html = open(os.path.join(TEST_FILE_PATH, filename)).read()
+            self.assertIsNone(crawler.extract_values_embedded(html), filename)
+
+    def test_invalid_json(self):
+        html = ('<html><head><title>T</title><script>vtex.events.addData({"productName": "P", </script>'
+                '</head></html>')
+        self.assertIsNone(crawler.extract_values_embedded(html))
+
+    def test_cheapest_available_sku(self):
+        sku_json = {'skus': [{'sku': 1, 'available': False, 'bestPrice': 1000, 'listPrice': 0},
+                             {'sku': 2, 'available': True, 'bestPrice': 3000, 'listPrice': 4000},
+                             {'sku': 3, 'available': True, 'bestPrice': 2000, 'listPrice': 0}]}
+        self.assertEqual({'sku': '3', 'price': 20.0, 'list_price': None, 'available': True},
+                         crawler.sku_values(sku_json))
+        for sku in sku_json['skus']:
+            sku['available'] = False
+        self.assertEqual({'sku': '1', 'price': 10.0, 'list_price': None, 'available': False},
+                         crawler.sku_values(sku_json))
+        self.assertEqual({}, crawler.sku_values(None))
+
+
+class TestExtractionSchema(unittest.TestCase):
+    """Tests the declarative extraction of the product values"""
+    schema_file = os.path.join(os.path.dirname(TEST_FILE_PATH), 'schemas', 'product.json')
+    product_pages = TestExtractValuesEmbedded.product_pages
+
+    def extract(self, spec, html):
+        return crawler.ExtractionSchema(spec).extract(html)[0]
+
+    def test_product_schema(self):
+        schema = crawler.load_schema(self.schema_file)
+        self.assertIs(schema, crawler.load_schema(self.schema_file))
+        self.assertEqual(('product_name', 'page_title', 'brand', 'sku', 'price', 'list_price', 'available', 'stock',
+                          'url'), schema.field_names)
+        html = open(os.path.join(TEST_FILE_PATH, self.product_pages[1])).read()
+        values, page = schema.extract(html)
+        self.assertFalse(page.parsed)
+        self.assertEqual({'product_name': 'Lady Million Eau my Gold Eau de Toilette Paco Rabanne - Perfume Feminino',
+                          'page_title': 'Perfume Lady Million Eau my Gold EDT Paco Rabanne Feminino - Época Cosméticos',
+                          'brand': 'Paco Rabanne', 'sku': '11444', 'price': 139.3, 'list_price': 399.0,
+                          'available': True, 'stock': 299997}, values)
+
+    def test_same_values_as_the_dom(self):
+        schema = crawler.load_schema(self.schema_file)
+        for filename in self.product_pages:
+            html = open(os.path.join(TEST_FILE_PATH, filename)).read()
+            values = schema.extract(html)[0]
+            self.assertEqual(crawler.extract_values(html),
+                             {'product_name': values['product_name'], 'page_title': values['page_title']})
+
+    def test_dom_fallback(self):
+        html = open(os.path.join(TEST_FILE_PATH, 'mock_page.html')).read().format(
+            'My first Fake Product', '\n    Fake\n    Product 1\n', 'page1/p', 'page2/p', 'page3/p')
+        values, page = crawler.load_schema(self.schema_file).extract(html)
+        self.assertTrue(page.parsed)
+        self.assertEqual({'product_name': 'Fake Product 1', 'page_title': 'My first Fake Product', 'brand': None,
+                          'sku': None, 'price': None, 'list_price': None, 'available': False, 'stock': 0}, values)
+
+    def test_required_field(self):
+        html = open(os.path.join(TEST_FILE_PATH, 'home_page.html')).read()
+        self.assertRaises(crawler.SchemaError, crawler.load_schema(self.schema_file).extract, html)
+
+    def test_rules(self):
+        html = """<html><head><title>T</title><meta name="brand" content="Marca">
+                  <script>window.stock = {"items": [{"qty": 2}, {"qty": 3}]};</script></head><body>
+                  <span class="price">R$ 1.299,90</span><a href="/1">Um</a><a href="/2">Dois</a></body></html>"""
+        spec = {'embedded': {'stock': r'window\.stock\s*=\s*'},
+                'fields': {'brand': {'xpath': '//meta[@name="brand"]', 'attr': 'content', 'post': 'upper'},
+                           'price': {'css': '.price', 'post': ['price']},
+                           'links': {'css': 'a', 'attr': 'href', 'all': True},
+                           'names': {'xpath': '//a/text()', 'all': True, 'post': ['lower', 'join']},
+                           'anchors': {'xpath': 'count(//a)', 'post': 'int'},
+                           'stock': {'json': 'stock.items.*.qty', 'post': 'sum'},
+                           'first_stock': {'json': 'stock.items.0.qty'},
+                           'title': {'regex': '<title>(.*?)</title>'},
+                           'color': {'css': '.color', 'default': 'none'}}}
+        self.assertEqual({'brand': 'MARCA', 'price': 1299.9, 'links': ['/1', '/2'], 'names': 'um dois',
+                          'anchors': 2, 'stock': 5, 'first_stock': 2, 'title': 'T', 'color': 'none'},
+                         self.extract(spec, html))
+
+    def test_invalid_schemas(self):
+        for spec in ([], {'fields': {}}, {'fields': {'a': 'b'}}, {'fields': {'a': {}}},
+                     {'fields': {'a': {'css': 'a', 'xpath': 'a'}}}, {'fields': {'a': {'html': 'a'}}},
+                     {'fields': {'a': {'css': 'a', 'unknown': 1}}}, {'fields': {'a': {'css': 'a[', 'post': []}}},
+                     {'fields': {'a': {'xpath': '//a['}}}, {'fields': {'a': {'regex': '('}}},
+                     {'fields': {'a': {'json': 'other.a'}}}, {'fields': {'a': {'css': 'a', 'post': ['reverse']}}},
+                     {'fields': {'a': {'first': [{'css': 'a'}], 'css': 'b'}}}, {'fields': {'a': {'first': []}}},
+                     {'fields': {'url': {'css': 'a'}}}, {'fields': {'a': {'css': 'a'}}, 'embedded': {'b': '('}}):
+            self.assertRaises(crawler.SchemaError, crawler.ExtractionSchema, spec)
+
+    @unittest.skipIf(crawler.yaml is None, 'PyYAML is not installed')
+    def test_yaml_schema(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'product.yaml')
+            with open(self.schema_file) as json_file, open(filename, 'w') as yaml_file:
+                crawler.yaml.safe_dump(json.load(json_file), yaml_file, sort_keys=False)
+            schema = crawler.load_schema(filename)
+            self.assertEqual(crawler.load_schema(self.schema_file).field_names, schema.field_names)
+            html = open(os.path.join(TEST_FILE_PATH, self.product_pages[0])).read()
+            self.assertEqual(crawler.load_schema(self.schema_file).extract(html)[0], schema.extract(html)[0])
+
+    def test_process_page(self):
+        url = 'http://www.epocacosmeticos.com.br/hypnose-eau-de-toilette-lancome-perfume-feminino/p'
+        html = open(os.path.join(TEST_FILE_PATH, self.product_pages[0])).read()
+        result = crawler.process_page(url, html, url, schema=self.schema_file)
+        self.assertEqual('Lancôme', result.values['brand'])
+        self.assertEqual(crawler.extract_links(html), result.links)
+        self.assertEqual({'extract_values', 'extract_links'}, set(result.stats))
+
+    def test_arguments(self):
+        config = crawler.parse_args(['--schema', os.path.relpath(self.schema_file), '/'])
+        self.assertEqual(self.schema_file, config.schema)
+        self.assertRaises(ValueError, crawler.parse_args, ['--schema', self.schema_file, '--prices', '/'])
+        self.assertRaises(crawler.SchemaError, crawler.parse_args, ['--schema', self.schema_file + '.missing', '/'])
+
+
 class TestExtractLinks(unittest.TestCase):
     """Tests the extraction of the pages links"""
 
@@ -332,6 +482,68 @@ class TestExtractLinks(unittest.TestCase):
                                                                           'page3/p')))
 
 
+class TestProcessPage(unittest.TestCase):
+    """Tests the single-parse processing of a downloaded page"""
+
+    def process(self, filename, url, response_url, parses, extractor='embedded'):
+        html = open(os.path.join(TEST_FILE_PATH, filename)).read()
+        with patch('crawler.parse_page', wraps=crawler.parse_page) as parse_page:
+            result = crawler.process_page(url, html, response_url, extractor)
+        self.assertEqual(parses, parse_page.call_count)
+        self.assertEqual(crawler.extract_links(html), result.links)
+        self.assertEqual(url, result.url)
+        return result
+
+    def test_product_page(self):
+        url = 'http://www.epocacosmeticos.com.br/hypnose-eau-de-toilette-lancome-perfume-feminino/p'
+        result = self.process('hypnose-eau-de-toilette-lancome-perfume-feminino.html', url, url, 0)
+        self.assertEqual({'product_name': 'Hypnôse Eau de Toilette Lancôme - Perfume Feminino - 30ml',
+                          'page_title': 'Hypnôse Lancôme - Perfume Feminino - Época Cosméticos',
+                          'sku': '6718', 'price': 249.9, 'list_price': None, 'available': True}, result.values)
+        self.assertEqual(174, len(result.links))
+        self.assertEqual({'extract_values', 'extract_links'}, set(result.stats))
+
+    def test_product_page_dom(self):
+        url = 'http://www.epocacosmeticos.com.br/hypnose-eau-de-toilette-lancome-perfume-feminino/p'
+        embedded = self.process('hypnose-eau-de-toilette-lancome-perfume-feminino.html', url, url, 0)
+        result = self.process('hypnose-eau-de-toilette-lancome-perfume-feminino.html', url, url, 1, 'dom')
+        self.assertEqual(embedded.values, result.values)
+        self.assertEqual({'parse', 'extract_values', 'extract_links'}, set(result.stats))
+
+    def test_product_page_without_embedded_data(self):
+        """A product page without the VTEX JSON is parsed"""
+        url = 'http://www.epocacosmeticos.com.br/page1/p'
+        html = open(os.path.join(TEST_FILE_PATH, 'mock_page.html')).read().format(
+            'My first Fake Product', 'Fake Product 1', 'page1/p', 'page2/p', 'page3/p')
+        with patch('crawler.parse_page', wraps=crawler.parse_page) as parse_page:
+            result = crawler.process_page(url, html, url)
+        self.assertEqual(1, parse_page.call_count)
+        self.assertEqual({'product_name': 'Fake Product 1', 'page_title': 'My first Fake Product'}, result.values)
+
+    def test_non_product_page(self):
+        url = 'http://www.epocacosmeticos.com.br/'
+        result = self.process('home_page.html', url, url, 0)
+        self.assertIsNone(result.values)
+        self.assertEqual(321, len(result.links))
+        self.assertEqual({'extract_links'}, set(result.stats))
+
+
+class TestExtractLinksFast(unittest.TestCase):
+    """Tests that the link scanner finds the same links as the DOM based extraction"""
+
+    def test_bundled_pages(self):
+        for path in sorted(glob.glob(os.path.join(TEST_FILE_PATH, '*.html'))):
+            html = open(path).read()
+            self.assertEqual(crawler.extract_links(html), crawler.extract_links_fast(html), path)
+
+    def test_markup_variations(self):
+        html = """<html><head><script>var a = '<a href="/script">';</script></head><body>
+                  <!-- <a href="/comment"> --><A class="x" HREF=/unquoted>1</A><a href='/single?a=1&amp;b=2'>2</a>
+                  <abbr href="/abbr"></abbr><a href="">3</a><a href="http://other.host/">4</a></body></html>"""
+        self.assertEqual(crawler.extract_links(html), crawler.extract_links_fast(html))
+        self.assertEqual(['/single?a=1&b=2', '/unquoted'], crawler.extract_links_fast(html))
+
+
 class TestIsProductPage(unittest.TestCase):
     """Tests for checking if a page is a prodcutd page"""
 
@@ -369,6 +581,45 @@ class TestArgParsing(unittest.TestCase):
         """URLS for domains other than http://www.epocacosmeticos.com.br/ should raise an exception"""
         self.assertRaises(ValueError, crawler.parse_args, ['invalid_url!'])
 
+    def test_base_url(self):
+        config = crawler.parse_args(['--base-url', 'http://127.0.0.1:8000/', '--robots', '--sitemap'])
+        self.assertEqual('http://127.0.0.1:8000/', config.path)
+        self.assertEqual('http://127.0.0.1:8000/robots.txt', config.robots)
+        self.assertEqual('http://127.0.0.1:8000/sitemap.xml', config.sitemap)
+        self.assertEqual('http://www.epocacosmeticos.com.br/robots.txt', crawler.parse_args(['/', '--robots']).robots)
+        self.assertRaises(ValueError, crawler.parse_args, ['--base-url', '127.0.0.1:8000', '/'])
+        self.assertRaises(ValueError, crawler.parse_args, ['--base-url', 'http://127.0.0.1:8000/loja', '/'])
+
+
+class TestSitemap(unittest.TestCase):
+    """Tests the streaming of the URLs in the local fixture sitemaps"""
+    index = os.path.join(TEST_FILE_PATH, 'sitemap_index.xml')
+
+    def test_index_and_gzipped_sitemaps(self):
+        urls = list(crawler.iter_sitemap(self.index))
+        self.assertEqual(7, len(urls))
+        self.assertEqual('http://www.epocacosmeticos.com.br/produto_1/p', urls[0])
+        self.assertIn('http://www.epocacosmeticos.com.br/pagina_2', urls)
+
+    def test_since_skips_old_pages_and_sitemaps(self):
+        urls = list(crawler.iter_sitemap(self.index, '2016-04-01'))
+        self.assertNotIn('http://www.epocacosmeticos.com.br/produto_2/p', urls)
+        self.assertNotIn('http://www.epocacosmeticos.com.br/produto_6/p', urls)
+        self.assertEqual(5, len(urls))
+
+    def test_scheduler_queues_only_product_pages(self):
+        config = crawler.parse_args(['--sitemap', self.index, '--since', '2016-04-01', '-o', os.devnull])
+        scheduler = crawler.CrawlScheduler(config)
+        self.assertEqual(['http://www.epocacosmeticos.com.br/produto_1/p',
+                          'http://www.epocacosmeticos.com.br/produto_3/p'], scheduler.next_tasks(10))
+        self.assertFalse(scheduler.finished)
+        scheduler.handle_result(None, ['/produto_9/p'], 'http://www.epocacosmeticos.com.br/produto_1/p')
+        scheduler.handle_result(None, [], 'http://www.epocacosmeticos.com.br/produto_3/p')
+        self.assertTrue(scheduler.finished)
+
+    def test_invalid_since(self):
+        self.assertRaises(ValueError, crawler.parse_args, ['--sitemap', '--since', '05/2016'])
+
 
 class TextExtractLinks(unittest.TestCase):
     """Tests the link extraction from the pages"""
@@ -381,5 +632,1189 @@ class TextExtractLinks(unittest.TestCase):
         home_page = open(os.path.join(TEST_FILE_PATH, 'hypnose-eau-de-toilette-lancome-perfume-feminino.html')).read()
         self.assertEqual(174, len(crawler.extract_links(home_page)))
 
+
+class TestFrontier(unittest.TestCase):
+    """Tests the frontier of URLs waiting to be visited"""
+
+    def test_deduplication(self):
+        frontier = crawler.Frontier(2)
+        self.assertTrue(frontier.push('/a', 0))
+        self.assertFalse(frontier.push('/a', 1))
+        self.assertEqual(1, len(frontier))
+
+    def test_depth_limit_per_url(self):
+        frontier = crawler.Frontier(1)
+        self.assertTrue(frontier.push('/a', 1))
+        self.assertFalse(frontier.push('/b', 2))
+        self.assertEqual([('/a', 1)], list(crawler.generate_tasks(frontier, 10)))
+
+    def test_shallower_urls_first(self):
+        frontier = crawler.Frontier(3)
+        frontier.push('/deep', 2)
+        frontier.push('/b', 1)
+        frontier.push('/a', 1)
+        frontier.push('/root', 0)
+        self.assertEqual([('/root', 0), ('/b', 1)], list(crawler.generate_tasks(frontier, 2)))
+        self.assertEqual([('/a', 1), ('/deep', 2)], list(crawler.generate_tasks(frontier, 10)))
+        self.assertFalse(frontier)
+
+    def test_found_again_at_shallower_depth(self):
+        frontier = crawler.Frontier(3)
+        frontier.push('/x', 3)
+        self.assertTrue(frontier.push('/x', 2))
+        self.assertFalse(frontier.push('/x', 3))
+        self.assertEqual(1, len(frontier))
+        self.assertEqual([('/x', 2)], list(crawler.generate_tasks(frontier, 10)))
+        self.assertFalse(frontier)
+        self.assertFalse(frontier.seen.mark_visited('/x'))
+        self.assertTrue(frontier.push('/x', 1))
+        self.assertTrue(frontier.seen.mark_visited('/x'))
+
+    def test_restore(self):
+        frontier = crawler.Frontier(3)
+        frontier.seen.add('/a', 1)
+        frontier.restore('/a', 2)
+        frontier.restore('/b', 2)
+        frontier.restore('/b', 2)
+        self.assertEqual(2, len(frontier))
+        self.assertEqual([('/a', 1), ('/b', 2)], list(crawler.generate_tasks(frontier, 10)))
+        self.assertFalse(frontier)
+
+
+class TestPriorityFrontier(unittest.TestCase):
+    """Tests the URL scoring of the priority frontier"""
+
+    def test_higher_priority_first(self):
+        frontier = crawler.Frontier(3)
+        frontier.push('/a', 1, 1.0)
+        frontier.push('/b', 2, 5.0)
+        frontier.push('/c', 1, 1.0)
+        self.assertEqual([('/b', 2), ('/a', 1), ('/c', 1)], list(crawler.generate_tasks(frontier, 10)))
+
+    def test_product_first_scorer(self):
+        scorer = crawler.product_first_scorer([('/pagina_*', 3.0)])
+        site = 'http://www.epocacosmeticos.com.br'
+        self.assertEqual(8.0, scorer(site + '/produto/p', 2))
+        self.assertEqual(1.0, scorer(site + '/outra', 1, from_product=True))
+        self.assertEqual(2.0, scorer(site + '/pagina_2', 1))
+        self.assertEqual(-6.0, scorer(site + '/account/orders', 1))
+
+    def test_scheduler_visits_products_first(self):
+        config = crawler.parse_args(['--prioritize', '--no-default-deny', '-d', '2', '-o', os.devnull, '/'])
+        scheduler = crawler.CrawlScheduler(config)
+        root = scheduler.next_tasks(1)[0]
+        scheduler.handle_result(None, ['/account/orders', '/pagina_2', '/produto_1/p'], root)
+        self.assertEqual(['http://www.epocacosmeticos.com.br/produto_1/p',
+                          'http://www.epocacosmeticos.com.br/pagina_2',
+                          'http://www.epocacosmeticos.com.br/account/orders'], scheduler.next_tasks(10))
+
+
+class TestUrlCanonicalizer(unittest.TestCase):
+    """Tests the canonicalization of the links before deduplication"""
+
+    def setUp(self):
+        self.canonicalizer = crawler.UrlCanonicalizer()
+
+    def test_relative_and_absolute_links(self):
+        page = 'http://www.epocacosmeticos.com.br/cabelos/shampoo'
+        self.assertEqual('http://www.epocacosmeticos.com.br/cabelos/p',
+                         self.canonicalizer('/cabelos/p', page))
+        self.assertEqual('http://www.epocacosmeticos.com.br/cabelos/condicionador',
+                         self.canonicalizer('condicionador', page))
+        self.assertEqual('http://www.epocacosmeticos.com.br/cabelos/p',
+                         self.canonicalizer('HTTP://WWW.EpocaCosmeticos.com.br:80/cabelos/p#top', page))
+
+    def test_query_parameters(self):
+        self.assertEqual('http://www.epocacosmeticos.com.br/cabelos/de-14,9-a-49,99?map=c,priceFrom',
+                         self.canonicalizer.canonicalize('/cabelos/de-14,9-a-49,99?map=c,priceFrom'))
+        self.assertEqual('http://www.epocacosmeticos.com.br/busca?a=1&b=2',
+                         self.canonicalizer.canonicalize('/busca?b=2&utm_source=x&a=1&gclid=y'))
+        self.assertEqual('http://www.epocacosmeticos.com.br/',
+                         self.canonicalizer.canonicalize('/?ProductLinkNotFound=fake-product/p'))
+
+    def test_keep_params(self):
+        canonicalizer = crawler.UrlCanonicalizer(keep_params=['map'])
+        self.assertEqual('http://www.epocacosmeticos.com.br/cabelos?map=c',
+                         canonicalizer.canonicalize('/cabelos?order=price&map=c'))
+
+    def test_path_encoding(self):
+        self.assertEqual('http://www.epocacosmeticos.com.br/Sem%20Am%C3%B4nia',
+                         self.canonicalizer.canonicalize('/Sem Amônia'))
+        self.assertEqual('http://www.epocacosmeticos.com.br/Sem%20Am%C3%B4nia',
+                         self.canonicalizer.canonicalize('/Sem%20Am%C3%B4nia'))
+
+    def test_counters(self):
+        for link in ['/a/p', 'http://www.epocacosmeticos.com.br/a/p', '/a/p#x', '/b/p']:
+            self.canonicalizer(link)
+        self.assertEqual(4, self.canonicalizer.links)
+        self.assertEqual(3, self.canonicalizer.rewritten)
+
+    def test_same_site(self):
+        self.assertTrue(self.canonicalizer.is_same_site(self.canonicalizer('/a/p')))
+        self.assertFalse(self.canonicalizer.is_same_site(self.canonicalizer('//evil.example.com/x/p')))
+        self.assertFalse(self.canonicalizer.is_same_site(self.canonicalizer('https://www.epocacosmeticos.com.br/a/p')))
+
+
+class TestUrlFilter(unittest.TestCase):
+    """Tests the rules that drop links before they are queued"""
+    site = 'http://www.epocacosmeticos.com.br'
+
+    def test_allow_and_deny_rules(self):
+        url_filter = crawler.UrlFilter(allow=['/*/p', 're:^/perfumes'], deny=['/account*', r're:[?&]PS=\d+'])
+        self.assertTrue(url_filter(self.site + '/produto/p'))
+        self.assertTrue(url_filter(self.site + '/perfumes/feminino'))
+        self.assertFalse(url_filter(self.site + '/account/orders'))
+        self.assertFalse(url_filter(self.site + '/perfumes?PS=20'))
+        self.assertFalse(url_filter(self.site + '/maquiagem'))
+        self.assertEqual({'deny /account*': 1, r'deny re:[?&]PS=\d+': 1, 'not allowed': 1}, url_filter.dropped)
+
+    def test_robots(self):
+        robots = crawler.load_robots(os.path.join(TEST_FILE_PATH, 'robots.txt'))
+        url_filter = crawler.UrlFilter(robots=robots)
+        self.assertFalse(url_filter(self.site + '/institucional/sobre'))
+        self.assertTrue(url_filter(self.site + '/produto/p'))
+        self.assertEqual({'robots.txt': 1}, url_filter.dropped)
+        self.assertEqual(1, robots.crawl_delay(crawler.USER_AGENT))
+
+    def test_max_query_variants(self):
+        url_filter = crawler.UrlFilter(max_query_variants=2)
+        for query in ('O=asc', 'O=desc', 'O=asc', 'O=price', ''):
+            url_filter(self.site + '/perfumes' + ('?' + query if query else ''))
+        self.assertEqual({'query variants': 1}, url_filter.dropped)
+
+
+class TestCrawlScheduler(unittest.TestCase):
+    """Tests how the scheduler queues the links of a visited page"""
+
+    def setUp(self):
+        self.scheduler = crawler.CrawlScheduler(crawler.parse_args(['-d', '2', '-o', os.devnull, '/']))
+        self.root = self.scheduler.next_tasks(1)[0]
+
+    def test_links_to_other_hosts_are_dropped(self):
+        self.scheduler.handle_result(None, ['//evil.example.com/x/p', '/a/p'], self.root)
+        self.assertEqual(['http://www.epocacosmeticos.com.br/a/p'], self.scheduler.next_tasks(10))
+        self.assertNotIn('http://evil.example.com/x/p', self.scheduler.frontier.seen)
+        self.assertEqual(1, self.scheduler.offsite_links)
+
+    def test_useless_links_are_filtered(self):
+        self.scheduler.handle_result(None, ['/account/orders', '/checkout/#/cart', '/a/p'], self.root)
+        self.assertEqual(['http://www.epocacosmeticos.com.br/a/p'], self.scheduler.next_tasks(10))
+        self.assertEqual({'deny /account*': 1, 'deny /checkout*': 1}, self.scheduler.url_filter.dropped)
+
+    def test_fetches_saved(self):
+        self.scheduler.handle_result(None, ['/a/p', 'http://www.epocacosmeticos.com.br/a/p', '/a/p#x',
+                                            '/b/p?utm_source=x', '/b/p'], self.root)
+        self.assertEqual(2, len(self.scheduler.frontier))
+        self.assertEqual(2, self.scheduler.fetches_saved)
+
+    def test_failed_pages_are_retried_by_error_class(self):
+        config = crawler.parse_args(['--retries', 'connection=1', '--retry-backoff', '0', '-o', os.devnull, '/'])
+        self.assertEqual({'connection': 1, 'http': 3, 'parse': 0, 'rejected': 0}, config.retries)
+        scheduler = crawler.CrawlScheduler(config)
+        root = scheduler.next_tasks(1)[0]
+        scheduler.handle_result(None, None, root, error='connection')
+        self.assertFalse(scheduler.finished)
+        self.assertEqual([root], scheduler.next_tasks(1))
+        scheduler.handle_result(None, None, root, error='connection')
+        self.assertTrue(scheduler.finished)
+        self.assertEqual((1, 1), (scheduler.retries, scheduler.failures))
+
+    def test_parse_errors_are_not_retried(self):
+        self.scheduler.handle_result(None, None, self.root, error='parse')
+        self.assertTrue(self.scheduler.finished)
+        self.assertEqual(1, self.scheduler.failures)
+
+    def test_max_products(self):
+        scheduler = crawler.CrawlScheduler(crawler.parse_args(['--max-products', '1', '-o', os.devnull, '/']))
+        root = scheduler.next_tasks(1)[0]
+        scheduler.handle_result({'product_name': 'Produto', 'page_title': 'Produto'}, ['/a/p', '/b/p'], root)
+        self.assertEqual([], scheduler.next_tasks(10))
+        self.assertTrue(scheduler.finished)
+        self.assertEqual('found 1 products', scheduler.stop_reason)
+
+    def test_time_budget(self):
+        scheduler = crawler.CrawlScheduler(crawler.parse_args(['--time-budget', '0.01', '-o', os.devnull, '/']))
+        time.sleep(0.02)
+        self.assertEqual([], scheduler.next_tasks(10))
+        self.assertTrue(scheduler.finished)
+
+    def test_invalid_retry_budget(self):
+        self.assertRaises(ValueError, crawler.parse_args, ['--retries', 'dns=1', '/'])
+
+    def test_incremental_crawl_writes_the_changes(self):
+        with tempfile.TemporaryDirectory() as directory:
+            args = ['-d', '2', '--incremental', os.path.join(directory, 'changes.db'), '-f', 'jsonl', '/']
+            product = {'product_name': 'Produto', 'page_title': 'Página'}
+            for run, (values, digest, expected) in enumerate((
+                    (product, 'a', [dict(product, change='new')]),
+                    (None, 'a', []),
+                    (dict(product, page_title='Página nova'), 'b', [dict(product, page_title='Página nova',
+                                                                         change='changed')]))):
+                output = os.path.join(directory, 'run{}.jsonl'.format(run))
+                scheduler = crawler.CrawlScheduler(crawler.parse_args(['-o', output] + args))
+                root = scheduler.next_tasks(1)[0]
+                self.assertEqual('' if run == 0 else 'a', scheduler.known_digest(root))
+                # An unchanged page comes back without values and links, which are taken from the store
+                scheduler.handle_result(values, ['/a/p'] if values else None, root, digest=digest)
+                self.assertEqual(['http://www.epocacosmeticos.com.br/a/p'], scheduler.next_tasks(10))
+                scheduler.handle_result(None, [], 'http://www.epocacosmeticos.com.br/a/p', digest='c')
+                scheduler.close()
+                with open(output) as output_file:
+                    self.assertEqual([dict(row, url=root) for row in expected],
+                                     [json.loads(line) for line in output_file])
+            self.assertEqual(1, scheduler.metrics.counters['changed'])
+
+    def test_incremental_crawl_reports_the_removed_products(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'output.csv')
+            config = crawler.parse_args(['--incremental', os.path.join(directory, 'changes.db'), '-o', output, '/'])
+            for links, products in ((['/a/p', '/b/p'], ('/a/p', '/b/p')), (['/a/p'], ())):
+                scheduler = crawler.CrawlScheduler(config)
+                root = scheduler.next_tasks(1)[0]
+                scheduler.handle_result(None, links, root, digest=str(len(links)))
+                for url in scheduler.next_tasks(10):
+                    path = url[len(crawler.DEFAULT_BASE_URL):]
+                    values = {'product_name': path} if path in products else None
+                    scheduler.handle_result(values, [], url, digest=str(values))
+                scheduler.close()
+            # The last crawl found that A is no longer a product, and no longer links to B
+            with open(output) as output_file:
+                self.assertCountEqual([['removed', '/a/p', '', 'http://www.epocacosmeticos.com.br/a/p'],
+                                       ['removed', '/b/p', '', 'http://www.epocacosmeticos.com.br/b/p']],
+                                      list(csv.reader(output_file)))
+
+    def test_incremental_crawl_is_not_distributed(self):
+        self.assertRaises(ValueError, crawler.parse_args, ['--incremental', 'changes.db', '--join', ':9000', '/'])
+
+
+class TestChangeStore(unittest.TestCase):
+    """Tests the store of the digests and values of the pages of an incremental crawl"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, 'changes.db')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_changes(self):
+        store = crawler.ChangeStore(self.filename)
+        self.assertIsNone(store.digest('http://a/p'))
+        self.assertEqual(('new', {'price': 1}, None, ['/b']),
+                         store.record('http://a/p', 'd1', {'price': 1}, ['/b'], keep_links=True))
+        self.assertEqual((None, None, None, ['/c']), store.record('http://c', 'd2', None, ['/c']))
+        store.close()
+        store = crawler.ChangeStore(self.filename)
+        self.assertEqual(2, store.run)
+        self.assertEqual('d1', store.digest('http://a/p', links=True))
+        self.assertIsNone(store.digest('http://c', links=True))
+        self.assertEqual('d2', store.digest('http://c'))
+        self.assertEqual((None, {'price': 1}, {'price': 1}, ['/b']), store.record('http://a/p', 'd1', None, None))
+        self.assertEqual(('changed', {'price': 2}, {'price': 1}, ['/b']),
+                         store.record('http://a/p', 'd3', {'price': 2}, ['/b']))
+        self.assertEqual((None, {'price': 2}, {'price': 2}, ['/b']),
+                         store.record('http://a/p', 'd4', {'price': 2}, ['/b']))
+        self.assertEqual(('removed', None, {'price': 2}, []), store.record('http://a/p', 'd5', None, []))
+        store.close()
+
+    def test_sweep(self):
+        store = crawler.ChangeStore(self.filename)
+        store.record('http://a/p', 'd1', {'price': 1}, [])
+        store.record('http://b/p', 'd2', {'price': 2}, [])
+        store.record('http://c', 'd3', None, [])
+        store.close()
+        store = crawler.ChangeStore(self.filename)
+        store.record('http://a/p', 'd1', None, None)
+        self.assertEqual([('http://b/p', {'price': 2})], list(store.sweep()))
+        self.assertIsNone(store.digest('http://c'))
+        self.assertEqual('d1', store.digest('http://a/p'))
+        store.close()
+
+    def test_resumed_run_is_continued(self):
+        store = crawler.ChangeStore(self.filename)
+        store.record('http://a/p', 'd1', {'price': 1}, [])
+        # Interrupted before it was closed
+        store.commit()
+        store._connection.close()
+        store = crawler.ChangeStore(self.filename, resuming=True)
+        self.assertEqual(1, store.run)
+        self.assertEqual([], list(store.sweep()))
+        store.close()
+        self.assertEqual(2, crawler.ChangeStore(self.filename, resuming=True).run)
+
+    def test_other_settings_process_every_page_again(self):
+        store = crawler.ChangeStore(self.filename, settings='a')
+        store.record('http://a/p', 'd1', {'price': 1}, [])
+        store.close()
+        store = crawler.ChangeStore(self.filename, settings='b')
+        self.assertIsNone(store.digest('http://a/p'))
+        self.assertEqual(('changed', {'price': 1, 'sku': 1}, {'price': 1}, []),
+                         store.record('http://a/p', 'd1', {'price': 1, 'sku': 1}, []))
+        store.close()
+
+
+class FakeTransport:
+    """Records the messages sent by a node and hands it the messages in its inbox"""
+
+    def __init__(self, inbox=()):
+        self.sent = []
+        self.inbox = list(inbox)
+        self.closed = False
+        self.lost = False
+
+    def send(self, message, node=None):
+        self.sent.append(message)
+
+    def flush(self):
+        if self.lost:
+            raise BrokenPipeError('The coordinator is gone')
+
+    def receive(self, timeout=0):
+        messages, self.inbox = self.inbox, []
+        return [(None, message) for message in messages]
+
+    def close(self):
+        self.closed = True
+
+
+class TestShardedScheduler(unittest.TestCase):
+    """Tests how a node of a distributed crawl shares the URLs with the other nodes"""
+
+    def setUp(self):
+        config = crawler.parse_args(['-d', '2', '-o', os.devnull, '/'])
+        self.root = crawler.UrlCanonicalizer(crawler.STRIP_PARAMS, []).canonicalize(config.path)
+        self.node = crawler.shard_of(self.root, 2)
+        self.transport = FakeTransport()
+        self.scheduler = crawler.ShardedScheduler(config, self.transport, self.node, 2, crawler.RESULT_FIELDS)
+        self.assertEqual([self.root], self.scheduler.next_tasks(1))
+
+    def visit_all(self):
+        """Visits the queued pages, finding no links on them, and returns their URLs"""
+        visited = []
+        tasks = self.scheduler.next_tasks(100)
+        while tasks:
+            for url in tasks:
+                self.scheduler.handle_result(None, [], url)
+            visited.extend(tasks)
+            tasks = self.scheduler.next_tasks(100)
+        return visited
+
+    def test_shard_of(self):
+        urls = ['http://www.epocacosmeticos.com.br/produto-{}/p'.format(n) for n in range(1000)]
+        shards = [crawler.shard_of(url, 4) for url in urls]
+        self.assertEqual(shards, [crawler.shard_of(url, 4) for url in urls])
+        self.assertTrue(all(200 < shards.count(shard) < 300 for shard in range(4)))
+
+    def test_links_are_sent_to_their_shard(self):
+        links = ['http://www.epocacosmeticos.com.br/produto-{}/p'.format(n) for n in range(20)]
+        self.scheduler.handle_result(None, links, self.root)
+        owned = [link for link in links if crawler.shard_of(link, 2) == self.node]
+        self.assertCountEqual(owned, self.visit_all())
+        self.assertEqual([{'type': 'links', 'node': 1 - self.node,
+                           'links': [[link, 1, False] for link in links if link not in owned]},
+                          {'type': 'status', 'received': 0}], self.transport.sent)
+        self.assertFalse(self.scheduler.finished)
+
+    def test_received_links_are_queued(self):
+        links = ['http://www.epocacosmeticos.com.br/produto-{}/p'.format(n) for n in range(20)]
+        owned = [link for link in links if crawler.shard_of(link, 2) == self.node]
+        self.transport.inbox = [{'type': 'links', 'links': [[link, 1, False] for link in owned + owned[:1]]}]
+        self.scheduler.handle_result(None, [], self.root)
+        self.assertCountEqual(owned, self.visit_all())
+        self.assertEqual(1, self.scheduler.received)
+        self.assertEqual([{'type': 'status', 'received': 1}], self.transport.sent)
+        self.assertFalse(self.scheduler.finished)
+        self.transport.inbox = [{'type': 'stop', 'reason': None}]
+        self.assertEqual([], self.scheduler.next_tasks(100))
+        self.assertTrue(self.scheduler.finished)
+        self.assertIsNone(self.scheduler.stop_reason)
+
+    def test_stop_waits_for_the_pages_in_flight(self):
+        self.transport.inbox = [{'type': 'stop', 'reason': 'found 10 products'}]
+        self.assertEqual([], self.scheduler.next_tasks(100))
+        self.assertFalse(self.scheduler.finished)
+        self.scheduler.handle_result(None, ['/a/p'], self.root)
+        self.assertEqual([], self.scheduler.next_tasks(100))
+        self.assertTrue(self.scheduler.finished)
+        self.assertEqual('found 10 products', self.scheduler.stop_reason)
+
+    def test_rows_are_sent_to_the_coordinator(self):
+        self.scheduler.handle_result({'product_name': 'Produto', 'page_title': 'Página'}, [], self.root)
+        self.scheduler.close()
+        self.assertEqual({'type': 'rows', 'rows': [['Produto', 'Página', self.root]]}, self.transport.sent[-2])
+        self.assertEqual('done', self.transport.sent[-1]['type'])
+        self.assertEqual(1, self.transport.sent[-1]['counters']['products'])
+        self.assertTrue(self.transport.closed)
+
+    def test_close_after_losing_the_coordinator(self):
+        self.transport.lost = True
+        self.scheduler.handle_result({'product_name': 'Produto', 'page_title': 'Página'}, [], self.root)
+        self.scheduler.close()
+        self.assertTrue(self.transport.closed)
+
+    def test_links_received_with_the_welcome(self):
+        owned = [link for link in ('http://www.epocacosmeticos.com.br/produto-{}/p'.format(n) for n in range(20))
+                 if crawler.shard_of(link, 2) == self.node]
+        transport = FakeTransport([{'type': 'welcome', 'node': self.node, 'nodes': 2, 'fields': ['url']},
+                                   {'type': 'links', 'links': [[link, 1, False] for link in owned]}])
+        config = crawler.parse_args(['--join', 'localhost:9000', '-d', '2', '-o', os.devnull, '/'])
+        with patch('crawler.connect_transport', return_value=transport):
+            self.scheduler = crawler.join_crawl(config)
+        self.assertEqual(('url',), self.scheduler.writer.fields)
+        self.assertIn(self.root, self.scheduler.next_tasks(1))
+        self.assertEqual(1, self.scheduler.received)
+        self.assertCountEqual(owned, self.visit_all())
+
+    def test_arguments(self):
+        self.assertRaises(ValueError, crawler.parse_args, ['--join', 'localhost:9000', '-r', 'resume.json', '/'])
+        self.assertRaises(ValueError, crawler.parse_args, ['--join', 'localhost:9000', '--coordinator', ':9000'])
+        config = crawler.parse_args(['--coordinator', 'unix:/tmp/crawl.sock', '--nodes', '3'])
+        self.assertEqual(('unix', '/tmp/crawl.sock'), crawler.parse_address(config.coordinator))
+        self.assertEqual(('tcp', 'localhost:9000'), crawler.parse_address('tcp://localhost:9000'))
+        self.assertEqual(('tcp', 'localhost:9000'), crawler.parse_address('localhost:9000'))
+
+
+class TestSocketTransport(unittest.TestCase):
+    """Tests the messages between the coordinator and the nodes of a distributed crawl"""
+
+    def exchange(self, address):
+        coordinator = []
+        thread = threading.Thread(target=lambda: coordinator.append(crawler.listen_transport(address, 2)))
+        thread.start()
+        nodes = [crawler.connect_transport(address) for _ in range(2)]
+        thread.join()
+        coordinator = coordinator[0]
+        try:
+            for node in range(2):
+                coordinator.send({'type': 'welcome', 'node': node}, node)
+            coordinator.flush()
+            welcomes = [node.receive(1) for node in nodes]
+            self.assertCountEqual([[(None, {'type': 'welcome', 'node': 0})], [(None, {'type': 'welcome', 'node': 1})]],
+                                  welcomes)
+            number = welcomes[0][0][1]['node']
+            # Larger than the socket buffers: the node blocks until it is sent, the coordinator doesn't
+            links = [['http://www.epocacosmeticos.com.br/produto-{}/p'.format(n), 1, False] for n in range(50000)]
+            sender = threading.Thread(target=lambda: (nodes[0].send({'type': 'links', 'node': 1 - number,
+                                                                     'links': links}), nodes[0].flush()))
+            sender.start()
+            received = []
+            while not received:
+                received = coordinator.receive(1)
+            sender.join()
+            self.assertEqual([(number, {'type': 'links', 'node': 1 - number, 'links': links})], received)
+            coordinator.send({'type': 'links', 'links': links}, 1 - number)
+            coordinator.flush()
+            forwarded = []
+            while not forwarded:
+                coordinator.receive(0)
+                forwarded = nodes[1].receive(0.1)
+            self.assertEqual([(None, {'type': 'links', 'links': links})], forwarded)
+            nodes[0].close()
+            closed = []
+            while not closed:
+                closed = coordinator.receive(1)
+            self.assertEqual([(number, None)], closed)
+        finally:
+            coordinator.close()
+            for node in nodes:
+                node.close()
+
+    def test_unix_socket(self):
+        with tempfile.TemporaryDirectory() as directory:
+            self.exchange('unix:' + os.path.join(directory, 'crawl.sock'))
+            self.assertEqual([], os.listdir(directory))
+
+    def test_tcp(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        self.exchange('127.0.0.1:{}'.format(port))
+
+    def test_lost_coordinator(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'crawl.sock')
+            thread = threading.Thread(target=lambda: crawler.listen_transport(address, 1).close())
+            thread.start()
+            node = crawler.connect_transport(address)
+            thread.join()
+            self.assertRaises(ConnectionError, node.receive, 1)
+            node.close()
+
+    def test_join_timeout(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'crawl.sock')
+            thread = threading.Thread(target=lambda: crawler.connect_transport(address).close())
+            thread.start()
+            with self.assertRaisesRegex(OSError, 'Only 1 of the 2 nodes joined within 0.5s'):
+                crawler.listen_transport(address, 2, timeout=0.5)
+            thread.join()
+            self.assertEqual([], os.listdir(directory))
+
+
+class TestRetryQueue(unittest.TestCase):
+    """Tests the backoff of the failed pages"""
+
+    def test_backoff_order(self):
+        clock = FakeClock()
+        retries = crawler.RetryQueue(clock)
+        retries.push('/a', 1, 2.0)
+        retries.push('/b', 2, 1.0)
+        retries.push('/c', 1, 3.0)
+        retries.discard('/c')
+        self.assertFalse(retries.ready())
+        self.assertEqual(1.0, retries.delay())
+        clock.now = 2.0
+        self.assertEqual([('/b', 2), ('/a', 1)], [retries.pop(), retries.pop()])
+        self.assertFalse(retries.ready())
+        self.assertIsNone(retries.delay())
+        self.assertEqual(0, len(retries))
+
+    def test_retry_delay(self):
+        for attempt, low, high in ((1, 0.5, 1), (3, 2, 4), (10, 30, 60)):
+            self.assertTrue(low <= crawler.retry_delay(attempt, 1.0) <= high)
+        self.assertEqual(30, crawler.retry_delay(1, 1.0, retry_after=30))
+
+
+class TestSeenSet(unittest.TestCase):
+    """Tests the stores of the URLs already queued"""
+
+    def check_store(self, seen):
+        self.assertTrue(seen.add('http://www.epocacosmeticos.com.br/a'))
+        self.assertFalse(seen.add('http://www.epocacosmeticos.com.br/a'))
+        self.assertTrue(seen.add('http://www.epocacosmeticos.com.br/b'))
+        self.assertIn('http://www.epocacosmeticos.com.br/b', seen)
+        self.assertNotIn('http://www.epocacosmeticos.com.br/c', seen)
+        self.assertEqual(2, len(seen))
+
+    def test_memory_store(self):
+        self.check_store(crawler.SeenSet())
+
+    def test_depth_and_visited(self):
+        seen = crawler.SeenSet()
+        self.assertTrue(seen.add('/a', 2))
+        self.assertFalse(seen.add('/a', 3))
+        self.assertFalse(seen.mark_visited('/a'))
+        self.assertTrue(seen.add('/a', 1))
+        self.assertTrue(seen.mark_visited('/a'))
+        self.assertEqual(1, len(seen))
+
+    def test_disk_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'seen.db')
+            seen = crawler.DiskSeenSet(filename, commit_every=1)
+            self.check_store(seen)
+            seen.close()
+            seen = crawler.DiskSeenSet(filename)
+            self.assertEqual(2, len(seen))
+            self.assertIn('http://www.epocacosmeticos.com.br/a', seen)
+            self.assertFalse(seen.mark_visited('http://www.epocacosmeticos.com.br/a'))
+            self.assertTrue(seen.add('http://www.epocacosmeticos.com.br/a', -1))
+            self.assertTrue(seen.mark_visited('http://www.epocacosmeticos.com.br/a'))
+            seen.close()
+
+    def check_queue(self, seen):
+        self.assertTrue(seen.add('/a', 2, queue=True))
+        self.assertTrue(seen.add('/a', 1, queue=True))
+        self.assertTrue(seen.add('/b', 1))
+        self.assertEqual(1, seen.queued)
+        self.assertFalse(seen.dequeue('/a', 2))
+        self.assertFalse(seen.dequeue('/b', 1))
+        self.assertTrue(seen.dequeue('/a', 1))
+        self.assertFalse(seen.dequeue('/a', 1))
+        self.assertEqual(0, seen.queued)
+        self.assertEqual(0, seen.restore('/a', 0))
+        self.assertEqual(1, seen.restore('/b', 3))
+        self.assertEqual(2, seen.restore('/c', 2))
+        self.assertEqual(3, seen.queued)
+        self.assertEqual(3, len(seen))
+
+    def test_queued_urls(self):
+        self.check_queue(crawler.SeenSet())
+        with tempfile.TemporaryDirectory() as directory:
+            seen = crawler.DiskSeenSet(os.path.join(directory, 'seen.db'))
+            self.check_queue(seen)
+            seen.close()
+            # The frontier of the crawl that left the file behind is gone
+            seen = crawler.DiskSeenSet(os.path.join(directory, 'seen.db'))
+            self.assertEqual(0, seen.queued)
+            self.assertFalse(seen.dequeue('/a', 0))
+            seen.close()
+            seen = crawler.BloomSeenSet(os.path.join(directory, 'bloom.db'))
+            self.check_queue(seen)
+            seen.close()
+
+    def test_bloom_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'seen.db')
+            seen = crawler.BloomSeenSet(filename, commit_every=1)
+            self.check_store(seen)
+            self.assertEqual(1, seen.lookups)
+            seen.close()
+            seen = crawler.BloomSeenSet(filename)
+            self.assertEqual(2, len(seen.filter))
+            self.assertIn('http://www.epocacosmeticos.com.br/a', seen)
+            self.assertFalse(seen.add('http://www.epocacosmeticos.com.br/b', 0))
+            self.assertTrue(seen.add('http://www.epocacosmeticos.com.br/a', -1))
+            seen.close()
+
+    def test_bloom_false_positives_are_confirmed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            seen = crawler.BloomSeenSet(os.path.join(directory, 'seen.db'), 0.5, initial_capacity=8)
+            memory = seen.stats()['memory_bytes']
+            for n in range(1000):
+                self.assertTrue(seen.add('/{}'.format(n), queue=True))
+            self.assertTrue(all(not seen.add('/{}'.format(n)) for n in range(1000)))
+            # Found again once more, they aren't looked up
+            self.assertTrue(all(not seen.add('/{}'.format(n), 1) for n in range(1000)))
+            self.assertTrue(all(seen.dequeue('/{}'.format(n), 0) for n in range(1000)))
+            stats = seen.stats()
+            self.assertEqual(1000, stats['urls'])
+            self.assertGreater(stats['false_positives'], 0)
+            self.assertEqual(1000 + stats['false_positives'], stats['lookups'])
+            self.assertEqual(1000, stats['recent_hits'])
+            self.assertGreater(stats['memory_bytes'], memory)
+            self.assertLess(stats['false_positive_rate'], 0.5)
+            seen.close()
+
+    def test_memory_stats(self):
+        seen = crawler.SeenSet()
+        empty = seen.stats()['memory_bytes']
+        for n in range(1000):
+            seen.add('/{}'.format(n))
+        stats = seen.stats()
+        self.assertEqual(1000, stats['urls'])
+        self.assertGreater(stats['memory_bytes'], empty + 1000 * 8)
+
+
+class TestScalableBloomFilter(unittest.TestCase):
+    """Tests the Bloom filter in front of the bloom seen store"""
+
+    def test_no_false_negatives(self):
+        bloom_filter = crawler.ScalableBloomFilter(0.01, initial_capacity=100)
+        fingerprints = [crawler.url_fingerprint('/{}'.format(n)) for n in range(2000)]
+        added = [bloom_filter.add(fingerprint) for fingerprint in fingerprints]
+        self.assertTrue(all(fingerprint in bloom_filter for fingerprint in fingerprints))
+        self.assertFalse(any(bloom_filter.add(fingerprint) for fingerprint in fingerprints))
+        self.assertEqual(sum(added), len(bloom_filter))
+
+    def test_false_positive_rate_stays_bounded(self):
+        bloom_filter = crawler.ScalableBloomFilter(0.01, initial_capacity=100)
+        for n in range(5000):
+            bloom_filter.add(crawler.url_fingerprint('/{}'.format(n)))
+        self.assertEqual(6, len(bloom_filter.filters))
+        false_positives = sum(crawler.url_fingerprint('/other/{}'.format(n)) in bloom_filter for n in range(20000))
+        self.assertLess(bloom_filter.false_positive_rate(), 0.01)
+        # The measured rate, with some slack for the sample
+        self.assertLess(false_positives / 20000, 0.015)
+        # About 10 bits per fingerprint at 1%, more for the tighter filters added as it grows, the newest half empty
+        self.assertLess(bloom_filter.memory(), 5000 * 3)
+
+    def test_invalid_rate(self):
+        self.assertRaises(ValueError, crawler.ScalableBloomFilter, 0)
+        self.assertRaises(ValueError, crawler.ScalableBloomFilter, 1)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestCrawlMetrics(unittest.TestCase):
+    """Tests the histograms, counters and reports of the crawl metrics"""
+
+    def test_histogram_percentiles(self):
+        histogram = crawler.Histogram((1, 2, 5, 10))
+        for value in (0.5, 1.5, 1.5, 3, 4, 4, 4, 7, 9, 50):
+            histogram.add(value)
+        self.assertEqual((10, 50), (histogram.count, histogram.max))
+        self.assertEqual(5, histogram.percentile(0.5))
+        self.assertEqual(10, histogram.percentile(0.9))
+        self.assertEqual(50, histogram.percentile(0.99))
+        self.assertEqual([[1, 1], [2, 2], [5, 4], [10, 2], [None, 1]], histogram.to_dict()['buckets'])
+        self.assertEqual(0.0, crawler.Histogram((1,)).percentile(0.5))
+
+    def test_record_pages(self):
+        clock = FakeClock()
+        metrics = crawler.CrawlMetrics(clock)
+        metrics.record_page({'connect': 0.01, 'ttfb': 0.02, 'download': 0.03},
+                            {'parse': 0.004, 'extract_values': 0.001, 'extract_links': 0.002, 'bytes': 2048}, 200)
+        metrics.record_page(None, None, 503, 'http')
+        metrics.record_page(error='connection')
+        metrics.gauge('frontier', 7)
+        metrics.gauge('frontier', 3)
+        clock.now = 2.0
+        self.assertEqual(1.5, metrics.pages_per_second())
+        self.assertEqual({'pages': 3, 'bytes': 2048}, metrics.counters)
+        self.assertEqual({'http': 1, 'connection': 1}, metrics.errors)
+        self.assertAlmostEqual(0.06, metrics.histograms['fetch_total'].total)
+        self.assertEqual(crawler.SIZE_BUCKETS, metrics.histograms['page_bytes'].bounds)
+        summary = metrics.summary()
+        self.assertIn('3 pages in 2s (1.5/s)', summary)
+        self.assertIn('errors: connection 1, http 1', summary)
+        self.assertIn('frontier 3', summary)
+        self.assertIn('fetch_total p50 60ms', summary)
+
+    def test_dump(self):
+        metrics = crawler.CrawlMetrics()
+        metrics.record_page({'connect': 0.0, 'ttfb': 0.1, 'download': 0.1}, {'bytes': 10}, 200)
+        metrics.gauge('in_flight', 4)
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'metrics.json')
+            metrics.dump(filename)
+            self.assertEqual([filename], glob.glob(os.path.join(directory, '*')))
+            with open(filename) as metrics_file:
+                dumped = json.load(metrics_file)
+        self.assertEqual({'200': 1}, dumped['statuses'])
+        self.assertEqual({'last': 4, 'max': 4}, dumped['gauges']['in_flight'])
+        self.assertEqual(1, dumped['histograms']['fetch_ttfb']['count'])
+
+    def test_scheduler_records_the_results(self):
+        scheduler = crawler.CrawlScheduler(crawler.parse_args(['-o', os.devnull, '/']))
+        root = scheduler.next_tasks(1)[0]
+        scheduler.handle_result({'product_name': 'Produto', 'page_title': 'Página'}, [], root,
+                                {'connect': 0.0, 'ttfb': 0.1, 'download': 0.1}, 200, stats={'bytes': 100})
+        scheduler.close()
+        self.assertEqual({'pages': 1, 'products': 1, 'bytes': 100}, scheduler.metrics.counters)
+        self.assertEqual((0, 1), scheduler.metrics.gauges['in_flight'])
+        self.assertEqual(1, scheduler.metrics.gauges['seen'][0])
+
+    def test_scheduler_records_the_bloom_seen_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            config = crawler.parse_args(['--seen-store', 'bloom', '--false-positive-rate', '0.01', '-o',
+                                         os.path.join(directory, 'teste.csv'), '/'])
+            scheduler = crawler.CrawlScheduler(config)
+            root = scheduler.next_tasks(1)[0]
+            scheduler.handle_result(None, ['/a', '/b', '/a'], root)
+            with self.assertLogs(crawler.logger) as logs:
+                scheduler.close()
+            self.assertEqual(['teste.csv'], os.listdir(directory))
+        self.assertEqual(3, scheduler.metrics.gauges['seen'][0])
+        # The Bloom filter, sized for a million URLs at 0.5%, and SQLite's page cache
+        self.assertGreater(scheduler.metrics.gauges['seen_kb'][0], 1024)
+        self.assertIn('Looked up 1 URLs the Bloom filter may have seen on disk, 0 of them false positives',
+                      '\n'.join(logs.output))
+
+
+class TestProfiling(unittest.TestCase):
+    """Tests the per worker profiles"""
+
+    def test_each_thread_writes_its_profile(self):
+        work = crawler.profiled(lambda: crawler.profiled(sum)(range(10)))
+        with tempfile.TemporaryDirectory() as directory:
+            crawler.start_profiling(directory)
+            try:
+                thread = threading.Thread(target=work, name='worker')
+                thread.start()
+                thread.join()
+                self.assertEqual(45, work())
+            finally:
+                crawler.stop_profiling()
+            profiles = sorted(os.listdir(directory))
+            self.assertEqual(['MainProcess-{}-MainThread.prof'.format(os.getpid()),
+                              'MainProcess-{}-worker.prof'.format(os.getpid())], profiles)
+            functions = pstats.Stats(os.path.join(directory, profiles[1])).stats
+            self.assertIn('sum', ' '.join(name for filename, line, name in functions))
+        self.assertEqual(45, work())
+
+
+class TestHostRateLimiter(unittest.TestCase):
+    """Tests the token bucket and the AIMD window of the rate limiter"""
+
+    def acquire_all(self, limiter):
+        acquired = 0
+        while limiter.acquire():
+            acquired += 1
+        return acquired
+
+    def test_window_grows_and_backs_off(self):
+        clock = FakeClock()
+        limiter = crawler.HostRateLimiter(16, initial_concurrency=2, clock=clock)
+        self.assertEqual(2, self.acquire_all(limiter))
+        for i in range(2):
+            clock.now += 0.1
+            limiter.release(status=200, latency=0.1)
+        self.assertEqual(4, self.acquire_all(limiter))
+        clock.now += 1
+        limiter.release(status=503, latency=0.1)
+        self.assertEqual(2.0, limiter.window)
+        limiter.release(status=429, latency=0.1)
+        self.assertEqual(2.0, limiter.window, 'backs off once per response time')
+        clock.now += 1
+        limiter.release(latency=1.0)
+        self.assertEqual(1.0, limiter.window, 'latency spike')
+        self.assertEqual(2, limiter.backoffs)
+        limiter.release(status=200, latency=0.1)
+        self.assertEqual(2.0, limiter.window, 'additive increase')
+
+    def test_retry_after(self):
+        clock = FakeClock()
+        limiter = crawler.HostRateLimiter(4, clock=clock)
+        self.assertTrue(limiter.acquire())
+        limiter.release(status=429, retry_after=5)
+        self.assertFalse(limiter.acquire())
+        self.assertEqual(5, limiter.delay())
+        clock.now += 5
+        self.assertTrue(limiter.acquire())
+
+    def test_token_bucket(self):
+        clock = FakeClock()
+        limiter = crawler.HostRateLimiter(100, rate=2, burst=2, initial_concurrency=100, clock=clock)
+        self.assertEqual(2, self.acquire_all(limiter))
+        self.assertEqual(0.5, limiter.delay())
+        clock.now += 0.5
+        self.assertEqual(1, self.acquire_all(limiter))
+
+    def test_parse_retry_after(self):
+        self.assertEqual(120, crawler.parse_retry_after('120'))
+        self.assertAlmostEqual(60, crawler.parse_retry_after(formatdate(time.time() + 60, usegmt=True)), delta=2)
+        self.assertIsNone(crawler.parse_retry_after('soon'))
+        self.assertIsNone(crawler.parse_retry_after(None))
+
+
+class TestCrawlJournal(unittest.TestCase):
+    """Tests the checkpoint of the crawl state"""
+
+    def test_load_and_compact(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'resume.json')
+            journal = crawler.CrawlJournal(filename, flush_every=2)
+            journal.queued('/a', 0)
+            journal.queued('/b', 2)
+            journal.visited('/a')
+            journal.queued('/b', 1)
+            journal.queued('/c', 1)
+            journal.visited('/b')
+            journal.queued('/a', 0)
+            journal.close()
+            with open(filename, 'a') as journal_file:
+                journal_file.write('["v", "/c"')
+            expected = {'/a': [0, True, True], '/b': [1, True, False], '/c': [1, False, True]}
+            self.assertEqual(expected, crawler.CrawlJournal(filename).load())
+            with open(filename) as journal_file:
+                self.assertEqual(6, len(journal_file.readlines()))
+            self.assertEqual(expected, crawler.CrawlJournal(filename).load())
+
+
+class TestResultWriter(unittest.TestCase):
+    """Tests the buffered writers of the product rows"""
+    rows = [['Produto 1', 'Página Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
+            ['Produto 2', 'Página Produto 2', 'http://www.epocacosmeticos.com.br/produto_2/p']]
+
+    def test_rows_are_buffered(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'output.csv')
+            writer = crawler.CsvResultWriter(filename, flush_every=2)
+            writer.write(self.rows[0])
+            self.assertEqual(0, os.path.getsize(filename))
+            writer.write(self.rows[1])
+            with open(filename, newline='') as csvfile:
+                self.assertEqual(self.rows, list(csv.reader(csvfile)))
+            writer.close()
+
+    def test_gzip_csv_append(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'output.csv.gz')
+            for row, append in zip(self.rows, (False, True)):
+                writer = crawler.GzipCsvResultWriter(filename, append)
+                writer.write(row)
+                writer.close()
+            with gzip.open(filename, 'rt', encoding='utf-8', newline='') as csvfile:
+                self.assertEqual(self.rows, list(csv.reader(csvfile)))
+
+    def test_json_lines(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'output.jsonl')
+            config = crawler.parse_args(['-o', filename, '/'])
+            writer = crawler.open_result_writer(config)
+            self.assertIsInstance(writer, crawler.JsonLinesResultWriter)
+            writer.write(self.rows[0])
+            writer.close()
+            with open(filename, encoding='utf-8') as jsonfile:
+                self.assertEqual({'product_name': 'Produto 1', 'page_title': 'Página Produto 1',
+                                  'url': 'http://www.epocacosmeticos.com.br/produto_1/p'}, json.loads(jsonfile.read()))
+
+    def test_price_fields(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'output.jsonl')
+            config = crawler.parse_args(['-o', filename, '--prices', '/'])
+            writer = crawler.open_result_writer(config)
+            self.assertEqual(crawler.RESULT_FIELDS + crawler.PRICE_FIELDS, writer.fields)
+            writer.write(self.rows[0] + ['6718', 249.9, None, True])
+            writer.close()
+            with open(filename, encoding='utf-8') as jsonfile:
+                row = json.loads(jsonfile.read())
+            self.assertEqual({'sku': '6718', 'price': 249.9, 'list_price': None, 'available': True},
+                             {field: row[field] for field in crawler.PRICE_FIELDS})
+
+
+class TestResponseCache(unittest.TestCase):
+    """Tests the on-disk response cache"""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = crawler.ResponseCache(os.path.join(self.directory.name, 'cache.db'))
+
+    def tearDown(self):
+        self.cache.close()
+        self.directory.cleanup()
+
+    def test_store_and_lookup(self):
+        headers = {'etag': '"v1"', 'content-type': 'text/html; charset=utf-8'}
+        self.assertTrue(self.cache.store('http://a/p', 'http://a/p', headers, 'Hypnôse'.encode('utf-8')))
+        self.assertEqual(crawler.CachedResponse('"v1"', None, 'http://a/p', 'text/html; charset=utf-8',
+                                                'Hypnôse'.encode('utf-8')),
+                         self.cache.lookup('http://a/p'))
+        self.assertIsNone(self.cache.lookup('http://b/p'))
+
+    def test_responses_without_validators_are_not_stored(self):
+        self.assertFalse(self.cache.store('http://a/p', 'http://a/p', {'content-type': 'text/html'}, b'page'))
+        self.assertIsNone(self.cache.lookup('http://a/p'))
+
+    def test_least_recently_used_are_evicted(self):
+        for url in ('http://a/p', 'http://b/p', 'http://c/p'):
+            self.cache.store(url, url, {'last-modified': 'Thu, 29 Sep 2016 00:00:00 GMT'}, os.urandom(1000))
+        self.cache.lookup('http://a/p')
+        self.cache.max_bytes = self.cache.size() - 1
+        self.cache.evict()
+        self.assertIsNotNone(self.cache.lookup('http://a/p'))
+        self.assertIsNone(self.cache.lookup('http://b/p'))
+        self.assertIsNotNone(self.cache.lookup('http://c/p'))
+
+
+class MockSiteHandler(BaseHTTPRequestHandler):
+    """Serves the mock product page gzipped, chunked or behind a redirect, depending on the path"""
+    protocol_version = 'HTTP/1.1'
+    page = open(os.path.join(TEST_FILE_PATH, 'mock_page.html')).read().format(
+        'Página Produto', 'Produto Hypnôse Lancôme', 'page1/p', 'page2/p', 'page3/p').encode('utf-8')
+    client_gone = threading.Event()
+
+    def do_GET(self):
+        if self.path == '/slow/p':
+            self.rfile.read(1)
+            MockSiteHandler.client_gone.set()
+            self.close_connection = True
+            return
+        if self.path == '/etag/p':
+            if self.headers.get('If-None-Match') == '"v1"':
+                self.send_response(304)
+                self.send_header('ETag', '"v1"')
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('ETag', '"v1"')
+            self.send_header('Content-Length', str(len(self.page)))
+            self.end_headers()
+            self.wfile.write(self.page)
+            return
+        if self.path == '/nocharset/p':
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(self.page)))
+            self.end_headers()
+            self.wfile.write(self.page)
+            return
+        if self.path == '/pdf/p':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(self.page)))
+            self.end_headers()
+            self.wfile.write(self.page)
+            return
+        if self.path == '/trickle/p':
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for start in range(0, len(self.page), 100):
+                    chunk = self.page[start:start + 100]
+                    self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+                    self.wfile.flush()
+                    time.sleep(0.1)
+                self.wfile.write(b'0\r\n\r\n')
+            except OSError:
+                pass
+            self.close_connection = True
+            return
+        if self.path == '/redirect/p':
+            self.send_response(302)
+            self.send_header('Location', '/?ProductLinkNotFound=redirect')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        if self.path == '/chunked/p':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for start in range(0, len(self.page), 100):
+                chunk = self.page[start:start + 100]
+                self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            body = gzip.compress(self.page)
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TestAsyncHttpClient(unittest.TestCase):
+    """Tests the asyncio engine's HTTP client against a local server"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = HTTPServer(('127.0.0.1', 0), MockSiteHandler)
+        cls.base_url = 'http://127.0.0.1:{}'.format(cls.server.server_port)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def fetch(self, *paths, **client_options):
+        async def fetch_all():
+            client = crawler.AsyncHttpClient(limit=2, **client_options)
+            try:
+                return [await crawler.fetch_page_async(client, self.base_url + path) for path in paths]
+            finally:
+                client.close()
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(fetch_all())
+        finally:
+            loop.close()
+
+    def test_gzip_and_chunked_bodies(self):
+        for html, response in self.fetch('/gzip/p', '/chunked/p', '/gzip/p'):
+            self.assertEqual(200, response.status_code)
+            self.assertEqual({'product_name': 'Produto Hypnôse Lancôme', 'page_title': 'Página Produto'},
+                             crawler.extract_values(html))
+
+    def test_redirect_is_followed(self):
+        html, response = self.fetch('/redirect/p')[0]
+        self.assertEqual(self.base_url + '/?ProductLinkNotFound=redirect', response.url)
+        self.assertFalse(crawler.is_product_page(self.base_url + '/redirect/p', response.url))
+
+    def test_conditional_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = crawler.ResponseCache(os.path.join(directory, 'cache.db'))
+            (html, first), (cached_html, second) = self.fetch('/etag/p', '/etag/p', cache=cache)
+            cache.close()
+        self.assertEqual(200, first.status_code)
+        self.assertEqual(304, second.status_code)
+        self.assertEqual(html, cached_html)
+        self.assertEqual(first.content, second.cached_body)
+
+    def test_pages_over_the_limits_are_rejected(self):
+        self.assertRaises(crawler.PageRejected, self.fetch, '/pdf/p')
+        for path in ('/gzip/p', '/chunked/p'):
+            self.assertRaises(crawler.PageRejected, self.fetch, path, max_size=0.0001)
+        self.assertRaises(asyncio.TimeoutError, self.fetch, '/trickle/p', total_timeout=0.15)
+
+    def test_timeout_closes_the_connection(self):
+        MockSiteHandler.client_gone.clear()
+        self.assertRaises(asyncio.TimeoutError, self.fetch, '/slow/p', read_timeout=0.2)
+        self.assertTrue(MockSiteHandler.client_gone.wait(5))
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer):
+    """The pooled session keeps its connection open after each test, which would block a single threaded server"""
+    daemon_threads = True
+
+
+class TestGetPageContents(unittest.TestCase):
+    """Tests the pooled HTTP session used by the pool engine"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadedHTTPServer(('127.0.0.1', 0), MockSiteHandler)
+        cls.base_url = 'http://127.0.0.1:{}'.format(cls.server.server_port)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        crawler._worker_state.session = None
+
+    def test_worker_gets_its_own_session(self):
+        crawler._worker_state.session = session = crawler.get_session()
+        with patch.dict(crawler.HTTP_OPTIONS):
+            crawler.init_worker({})
+        self.assertIsNot(session, crawler.get_session())
+
+    def test_connection_is_reused(self):
+        html, first = crawler.get_page_contents(self.base_url + '/gzip/p')
+        self.assertEqual('Produto Hypnôse Lancôme', crawler.extract_values(html)['product_name'])
+        html, second = crawler.get_page_contents(self.base_url + '/chunked/p')
+        self.assertEqual('Produto Hypnôse Lancôme', crawler.extract_values(html)['product_name'])
+        self.assertGreater(first.timings['connect'], 0)
+        self.assertEqual(0, second.timings['connect'])
+        self.assertGreaterEqual(second.timings['ttfb'], 0)
+        self.assertGreaterEqual(second.timings['download'], 0)
+
+    def test_conditional_request(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with patch.dict(crawler.HTTP_OPTIONS, {'cache': os.path.join(directory, 'cache.db')}):
+                html, first = crawler.get_page_contents(self.base_url + '/etag/p')
+                cached_html, second = crawler.get_page_contents(self.base_url + '/etag/p')
+                crawler.get_cache().close()
+                del crawler._worker_state.cache
+        self.assertEqual(200, first.status_code)
+        self.assertFalse(first.from_cache)
+        self.assertEqual(304, second.status_code)
+        self.assertTrue(second.from_cache)
+        self.assertEqual(html, cached_html)
+        self.assertEqual(first.content, second.cached_body)
+
+    def test_unchanged_page_is_not_processed(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with patch.dict(crawler.HTTP_OPTIONS, {'cache': os.path.join(directory, 'cache.db')}):
+                first = crawler.visit_url(self.base_url + '/etag/p', digest='')
+                with patch('crawler.process_page') as process_page:
+                    second = crawler.visit_url(self.base_url + '/etag/p', digest=first.digest)
+                crawler.get_cache().close()
+                del crawler._worker_state.cache
+        self.assertEqual('Produto Hypnôse Lancôme', first.values['product_name'])
+        self.assertEqual(32, len(first.digest))
+        self.assertEqual((None, None, 304, first.digest), (second.values, second.links, second.status, second.digest))
+        process_page.assert_not_called()
+        self.assertIsNone(crawler.visit_url(self.base_url + '/gzip/p').digest)
+
+    def test_pages_over_the_limits_are_rejected(self):
+        self.assertRaises(crawler.PageRejected, crawler.get_page_contents, self.base_url + '/pdf/p')
+        with patch.dict(crawler.HTTP_OPTIONS, {'max_size': 0.0001}):
+            for path in ('/gzip/p', '/chunked/p'):
+                self.assertRaises(crawler.PageRejected, crawler.get_page_contents, self.base_url + path)
+        with patch.dict(crawler.HTTP_OPTIONS, {'total_timeout': 0.15}):
+            self.assertRaises(TimeoutError, crawler.get_page_contents, self.base_url + '/trickle/p')
+
+    def test_same_text_as_asyncio_engine_without_charset(self):
+        async def fetch():
+            client = crawler.AsyncHttpClient()
+            try:
+                return await crawler.fetch_page_async(client, self.base_url + '/nocharset/p')
+            finally:
+                client.close()
+        loop = asyncio.new_event_loop()
+        try:
+            async_html, response = loop.run_until_complete(fetch())
+        finally:
+            loop.close()
+        html, response = crawler.get_page_contents(self.base_url + '/nocharset/p')
+        self.assertEqual(html, async_html)
+        self.assertEqual('Produto Hypnôse Lancôme', crawler.extract_values(html)['product_name'])
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -6,12 +6,17 @@ Functional tests for the PriceCrawler project.
 
 import unittest
 import os
+import sys
 import subprocess
 import csv
+import json
+import tempfile
+from time import sleep
 from unittest.mock import patch
 from urllib.parse import urlparse
 
 import crawler
+import mock_site
 from tests import PROJECT_ROOT, TEST_FILE_PATH
 
 CRAWLER_EXECUTABLE = os.path.join(PROJECT_ROOT, 'crawler.py')
@@ -39,6 +44,52 @@ class MockPageGenerator:
         return (self.mock_page.format(*self.par_by_path.get(path, ['Empty' for n in range(5)])), MockResponse)
 
 
+class SlowMockPageGenerator(MockPageGenerator):
+    """MockPageGenerator that takes the given number of seconds to answer some paths
+
+    Args:
+        par_by_path (dict): {path: [parameters]}
+        delay_by_path (dict): {path: seconds}
+    """
+    def __init__(self, par_by_path, delay_by_path):
+        super().__init__(par_by_path)
+        self.delay_by_path = delay_by_path
+
+    def __call__(self, url):
+        sleep(self.delay_by_path.get(urlparse(url).path, 0))
+        return super().__call__(url)
+
+
+class ThrottlingMockPageGenerator(MockPageGenerator):
+    """MockPageGenerator that answers 429 Too Many Requests the first time some paths are requested
+
+    Args:
+        par_by_path (dict): {path: [parameters]}
+        throttled_paths (iterable): The paths answered with 429 once
+    """
+    def __init__(self, par_by_path, throttled_paths):
+        super().__init__(par_by_path)
+        self.throttled_paths = set(throttled_paths)
+
+    def __call__(self, url):
+        path = urlparse(url).path
+        if path in self.throttled_paths:
+            self.throttled_paths.discard(path)
+
+            class ThrottledResponse:
+                status_code = 429
+                headers = {'retry-after': '0.1'}
+            ThrottledResponse.url = url
+            return '', ThrottledResponse
+        return super().__call__(url)
+
+
+class AsyncMockPageGenerator(MockPageGenerator):
+    """Asyncio counterpart of MockPageGenerator, replacing crawler.fetch_page_async"""
+    async def __call__(self, client, url):
+        return super().__call__(url)
+
+
 class TestCrawler(unittest.TestCase):
     """Tests the extraction of the page title, product name and URL from a single page."""
     def execute_command(self, page, depth=0):
@@ -93,6 +144,10 @@ class TestMainFunction(unittest.TestCase):
         if os.path.exists('teste.json'):
             os.remove('teste.json')
 
+    def tearDown(self):
+        if os.path.exists('teste.json'):
+            os.remove('teste.json')
+
     def load_result_csv(self):
         with open('teste.csv') as csvfile:
             csvreader = csv.reader(csvfile)
@@ -151,7 +206,7 @@ class TestMainFunction(unittest.TestCase):
                        '/produto_2/p': ('Pagina Produto 2', 'Produto 2', 'produto_7/p', 'produto_8/p', 'produto_9/p'),
                        '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'produto_10/p', 'produto_11/p', 'produto_12/p')}
         with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
-            crawler.main(['-d', '1', '-o', 'teste.csv', '/produto_inicial/p'])
+            crawler.main(['-w', '1', '-d', '1', '-o', 'teste.csv', '/produto_inicial/p'])
         expected = [['Produto Inicial', 'Pagina Inicial', 'http://www.epocacosmeticos.com.br/produto_inicial/p'],
                     ['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
                     ['Produto 2', 'Pagina Produto 2', 'http://www.epocacosmeticos.com.br/produto_2/p'],
@@ -164,7 +219,7 @@ class TestMainFunction(unittest.TestCase):
                        '/pagina_2': ('Pagina Produto 2', 'Produto 2', 'pagina_7', 'pagina_8', 'pagina_9'),
                        '/pagina_3': ('Pagina Produto 3', 'Produto 3', 'pagina_10', 'pagina_11', 'pagina_12')}
         with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
-            crawler.main(['-d', '1', '-o', 'teste.csv', '/pagina_inicial'])
+            crawler.main(['-w', '1', '-d', '1', '-o', 'teste.csv', '/pagina_inicial'])
         expected = []
         self.assertEqual(expected, self.load_result_csv())
 
@@ -174,7 +229,7 @@ class TestMainFunction(unittest.TestCase):
                        '/pagina_2': ('Pagina 2', 'Página 2', 'pagina_7', 'pagina_8', 'pagina_9'),
                        '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'pagina_10', 'pagina_11', 'pagina_12')}
         with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
-            crawler.main(['-d', '1', '-o', 'teste.csv', '/pagina_inicial'])
+            crawler.main(['-w', '1', '-d', '1', '-o', 'teste.csv', '/pagina_inicial'])
         expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
                     ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p']]
         self.assertEqual(expected, self.load_result_csv())
@@ -189,10 +244,175 @@ class TestMainFunction(unittest.TestCase):
             '/pagina_6': ('Pagina 6', 'Página 2', 'produto_1/p', 'pagina_5', 'produto_3/p'),
         }
         with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
-            crawler.main(['-d', '2', '-o', 'teste.csv', '/pagina_inicial'])
+            crawler.main(['-w', '1', '-d', '2', '-o', 'teste.csv', '/pagina_inicial'])
+        expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
+                    ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p']]
+        self.assertEqual(expected, self.load_result_csv())
+
+    def test_crawl_mock_pages_many_workers(self):
+        """With several workers the rows come in completion order, but the same pages are visited"""
+        mock_params = {
+            '/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'produto_1/p', 'pagina_2', 'produto_3/p'),
+            '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'produto_3/p', 'pagina_5', 'pagina_6'),
+            '/pagina_2': ('Pagina 2', 'Página 2', 'produto_2/p', 'pagina_5', 'produto_3/p'),
+            '/produto_2/p': ('Pagina Produto 2', 'Produto 2', 'produto_4/p', 'produto_5/p', 'pagina_1'),
+            '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'produto_1/p', 'pagina_5', 'pagina_6'),
+            '/produto_4/p': ('Pagina Produto 4', 'Produto 4', 'pagina_inicial', 'pagina_6', 'produto_5/p'),
+        }
+        with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
+            crawler.main(['-w', '8', '-d', '2', '-o', 'teste.csv', '/pagina_inicial'])
+        expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
+                    ['Produto 2', 'Pagina Produto 2', 'http://www.epocacosmeticos.com.br/produto_2/p'],
+                    ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p']]
+        self.assertCountEqual(expected, self.load_result_csv())
+
+    def test_crawl_mock_pages_slow_shallow_page(self):
+        """A URL first reported by a fast deeper page keeps the depth given by the slower, shallower page"""
+        mock_params = {
+            '/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'pagina_lenta', 'pagina_rapida', 'pagina_inicial'),
+            '/pagina_lenta': ('Pagina Lenta', 'Página Lenta', 'produto_x/p', 'pagina_lenta', 'pagina_inicial'),
+            '/pagina_rapida': ('Pagina Rapida', 'Página Rápida', 'pagina_g', 'pagina_rapida', 'pagina_inicial'),
+            '/pagina_g': ('Pagina G', 'Página G', 'produto_x/p', 'pagina_g', 'pagina_inicial'),
+            '/produto_x/p': ('Pagina Produto X', 'Produto X', 'produto_y/p', 'pagina_g', 'pagina_inicial'),
+            '/produto_y/p': ('Pagina Produto Y', 'Produto Y', 'pagina_g', 'pagina_g', 'pagina_inicial'),
+        }
+        with patch('crawler.get_page_contents', SlowMockPageGenerator(mock_params, {'/pagina_lenta': 1})):
+            crawler.main(['-w', '4', '-d', '3', '-o', 'teste.csv', '/pagina_inicial'])
+        expected = [['Produto X', 'Pagina Produto X', 'http://www.epocacosmeticos.com.br/produto_x/p'],
+                    ['Produto Y', 'Pagina Produto Y', 'http://www.epocacosmeticos.com.br/produto_y/p']]
+        self.assertEqual(expected, self.load_result_csv())
+
+    def test_crawl_mock_pages_canonical_links(self):
+        mock_params = {'/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'produto_1/p', 'produto_1/p#avaliacoes',
+                                           'produto_1/p?utm_source=home'),
+                       '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'pagina_inicial', 'pagina_5', 'pagina_6')}
+        with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
+            crawler.main(['-w', '1', '-d', '1', '-o', 'teste.csv', '/pagina_inicial'])
+        expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p']]
+        self.assertEqual(expected, self.load_result_csv())
+
+    def test_crawl_mock_pages_disk_seen_store(self):
+        mock_params = {'/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'produto_1/p', 'pagina_2', 'produto_3/p'),
+                       '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'pagina_4', 'pagina_5', 'pagina_6'),
+                       '/pagina_2': ('Pagina 2', 'Página 2', 'pagina_7', 'pagina_8', 'pagina_9'),
+                       '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'pagina_10', 'pagina_11', 'pagina_12')}
+        with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
+            crawler.main(['-w', '1', '-d', '1', '-o', 'teste.csv', '--seen-store', 'disk', '/pagina_inicial'])
+        self.assertFalse(os.path.exists('teste.csv.seen'))
+        expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
+                    ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p']]
+        self.assertEqual(expected, self.load_result_csv())
+
+    def test_crawl_mock_pages_bloom_seen_store(self):
+        mock_params = {'/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'produto_1/p', 'pagina_2', 'produto_3/p'),
+                       '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'pagina_inicial', 'produto_3/p', 'pagina_2'),
+                       '/pagina_2': ('Pagina 2', 'Página 2', 'produto_1/p', 'pagina_inicial', 'pagina_9'),
+                       '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'pagina_2', 'produto_1/p', 'pagina_12')}
+        with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
+            crawler.main(['-w', '1', '-d', '2', '-o', 'teste.csv', '--seen-store', 'bloom', '--false-positive-rate',
+                          '0.01', '/pagina_inicial'])
+        self.assertFalse(os.path.exists('teste.csv.seen'))
+        expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
+                    ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p']]
+        self.assertEqual(expected, self.load_result_csv())
+
+    def test_existing_seen_file_is_kept(self):
+        with open('teste.seen', 'w') as seen_file:
+            seen_file.write('not a crawl')
+        try:
+            self.assertRaises(SystemExit, crawler.main, ['-o', 'teste.csv', '--seen-store', 'disk',
+                                                         '--seen-file', 'teste.seen', '/'])
+            with open('teste.seen') as seen_file:
+                self.assertEqual('not a crawl', seen_file.read())
+        finally:
+            os.remove('teste.seen')
+
+    def test_throttled_pages_are_visited_again(self):
+        mock_params = {
+            '/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'produto_1/p', 'pagina_2', 'produto_3/p'),
+            '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'produto_3/p', 'pagina_5', 'pagina_6'),
+            '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'produto_2/p', 'produto_4/p', 'produto_6/p'),
+            '/pagina_2': ('Pagina 2', 'Página 2', 'produto_2/p', 'pagina_1', 'pagina_3'),
+        }
+        with patch('crawler.get_page_contents', ThrottlingMockPageGenerator(mock_params, ['/produto_1/p'])):
+            crawler.main(['-w', '1', '-d', '1', '--retry-backoff', '0.1', '-o', 'teste.csv', '/pagina_inicial'])
         expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
                     ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p']]
+        self.assertCountEqual(expected, self.load_result_csv())
+
+    def test_worker_exceptions_are_retried(self):
+        mock_params = {
+            '/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'produto_1/p', 'pagina_2', 'produto_3/p'),
+            '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'pagina_4', 'pagina_5', 'pagina_6'),
+            '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'pagina_10', 'pagina_11', 'pagina_12'),
+        }
+        visit_url = crawler.visit_url
+        failed = []
+
+        def failing_visit_url(url, *args, **kwargs):
+            if url.endswith('/produto_1/p') and not failed:
+                failed.append(url)
+                raise RuntimeError('The worker crashed')
+            return visit_url(url, *args, **kwargs)
+
+        with patch('crawler.get_page_contents', MockPageGenerator(mock_params)), \
+                patch('crawler.visit_url', failing_visit_url):
+            crawler.main(['-w', '1', '--worker-kind', 'thread', '-d', '1', '--retry-backoff', '0', '-o', 'teste.csv',
+                          '/pagina_inicial'])
+        self.assertEqual(1, len(failed))
+        expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
+                    ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p']]
+        self.assertCountEqual(expected, self.load_result_csv())
+
+    def test_crawl_sitemap(self):
+        mock_params = {
+            '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'produto_3/p', 'pagina_5', 'pagina_6'),
+            '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'produto_2/p', 'produto_4/p', 'produto_6/p'),
+            '/pagina_5': ('Pagina 5', 'Página 5', 'produto_2/p', 'pagina_4', 'produto_4/p'),
+        }
+        with patch('crawler.get_page_contents', wraps=MockPageGenerator(mock_params)) as get_page_contents:
+            crawler.main(['-w', '1', '--worker-kind', 'thread', '-o', 'teste.csv', '--since', '2016-04-01',
+                          '--sitemap', os.path.join(TEST_FILE_PATH, 'sitemap_index.xml')])
+        expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
+                    ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p']]
+        self.assertEqual(expected, self.load_result_csv())
+        self.assertEqual(2, get_page_contents.call_count)
+
+    def test_prioritized_crawl_stops_at_max_products(self):
+        mock_params = {
+            '/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'pagina_2', 'pagina_5', 'produto_3/p'),
+            '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'pagina_6', 'produto_4/p', 'produto_6/p'),
+            '/produto_4/p': ('Pagina Produto 4', 'Produto 4', 'pagina_inicial', 'pagina_6', 'produto_5/p'),
+            '/produto_6/p': ('Pagina Produto 6', 'Produto 6', 'pagina_inicial', 'pagina_1', 'produto_5/p'),
+            '/pagina_2': ('Pagina 2', 'Página 2', 'produto_2/p', 'pagina_1', 'pagina_3'),
+            '/pagina_5': ('Pagina 5', 'Página 5', 'produto_2/p', 'pagina_4', 'produto_4/p'),
+        }
+        with patch('crawler.get_page_contents', wraps=MockPageGenerator(mock_params)) as get_page_contents:
+            crawler.main(['-w', '1', '--worker-kind', 'thread', '-d', '2', '--prioritize', '--max-products', '2',
+                          '-o', 'teste.csv', '/pagina_inicial'])
+        expected = [['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p'],
+                    ['Produto 4', 'Pagina Produto 4', 'http://www.epocacosmeticos.com.br/produto_4/p']]
         self.assertEqual(expected, self.load_result_csv())
+        self.assertEqual(3, get_page_contents.call_count)
+
+    def test_metrics_and_worker_profiles(self):
+        mock_params = {
+            '/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'produto_1/p', 'pagina_2', 'produto_3/p'),
+            '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'produto_3/p', 'pagina_5', 'pagina_6'),
+            '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'produto_2/p', 'produto_4/p', 'produto_6/p'),
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
+                crawler.main(['-w', '2', '-d', '1', '-o', 'teste.csv', '--metrics', os.path.join(directory, 'm.json'),
+                              '--profile', os.path.join(directory, 'profiles'), '/pagina_inicial'])
+            with open(os.path.join(directory, 'm.json')) as metrics_file:
+                metrics = json.load(metrics_file)
+            profiles = os.listdir(os.path.join(directory, 'profiles'))
+        self.assertEqual({'pages': 4, 'products': 2, 'bytes': 0}, metrics['counters'])
+        self.assertEqual(2, metrics['histograms']['extract_values']['count'])
+        self.assertEqual(4, metrics['histograms']['extract_links']['count'])
+        self.assertTrue([profile for profile in profiles if profile.startswith('ForkPoolWorker')])
+        self.assertIn('MainProcess-{}-MainThread.prof'.format(os.getpid()), profiles)
 
     def test_crawl_mock_pages_with_persistence(self):
         mock_params = {
@@ -221,7 +441,7 @@ class TestMainFunction(unittest.TestCase):
         #             ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p']]
         # self.assertEqual(expected, self.load_result_csv())
         with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
-            crawler.main(['-d', '2', '-o', 'teste.csv', '-r', 'teste.json', '/pagina_inicial'])
+            crawler.main(['-w', '1', '-d', '2', '-o', 'teste.csv', '-r', 'teste.json', '/pagina_inicial'])
         expected = [['Produto 1', 'Pagina Produto 1', 'http://www.epocacosmeticos.com.br/produto_1/p'],
                     ['Produto 3', 'Pagina Produto 3', 'http://www.epocacosmeticos.com.br/produto_3/p'],
                     ['Produto 2', 'Pagina Produto 2', 'http://www.epocacosmeticos.com.br/produto_2/p'],
@@ -229,5 +449,215 @@ class TestMainFunction(unittest.TestCase):
                     ['Produto 6', 'Pagina Produto 6', 'http://www.epocacosmeticos.com.br/produto_6/p']]
         self.assertEqual(expected, self.load_result_csv())
 
+    def test_resume_interrupted_crawl(self):
+        mock_params = {
+            '/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'produto_1/p', 'pagina_2', 'produto_3/p'),
+            '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'produto_3/p', 'pagina_5', 'pagina_6'),
+            '/produto_2/p': ('Pagina Produto 2', 'Produto 2', 'produto_4/p', 'produto_5/p', 'pagina_1'),
+            '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'produto_2/p', 'produto_4/p', 'produto_6/p'),
+            '/produto_4/p': ('Pagina Produto 4', 'Produto 4', 'pagina_inicial', 'pagina_6', 'produto_5/p'),
+            '/produto_6/p': ('Pagina Produto 6', 'Produto 6', 'pagina_inicial', 'pagina_1', 'produto_5/p'),
+            '/pagina_2': ('Pagina 2', 'Página 2', 'produto_2/p', 'pagina_1', 'pagina_3'),
+            '/pagina_5': ('Pagina 5', 'Página 5', 'produto_2/p', 'pagina_4', 'produto_4/p'),
+            '/pagina_6': ('Pagina 6', 'Página 6', 'pagina_inicial', 'pagina_5', 'produto_3/p'),
+        }
+        site = 'http://www.epocacosmeticos.com.br/'
+        # The checkpoint of a crawl killed after visiting the two first pages, in the middle of writing a line
+        with open('teste.json', 'w') as journal:
+            for event in (['q', site + 'pagina_inicial', 0], ['q', site + 'produto_1/p', 1],
+                          ['q', site + 'pagina_2', 1], ['q', site + 'produto_3/p', 1], ['v', site + 'pagina_inicial'],
+                          ['q', site + 'pagina_5', 2], ['q', site + 'pagina_6', 2], ['v', site + 'produto_1/p']):
+                journal.write(json.dumps(event) + '\n')
+            journal.write('["q", "' + site)
+        with open('teste.csv', 'w') as output:
+            output.write('Produto 1,Pagina Produto 1,{}produto_1/p\n'.format(site))
+        with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
+            crawler.main(['-w', '1', '-d', '2', '-o', 'teste.csv', '-r', 'teste.json', '/pagina_inicial'])
+        expected = [['Produto 1', 'Pagina Produto 1', site + 'produto_1/p'],
+                    ['Produto 3', 'Pagina Produto 3', site + 'produto_3/p'],
+                    ['Produto 2', 'Pagina Produto 2', site + 'produto_2/p'],
+                    ['Produto 4', 'Pagina Produto 4', site + 'produto_4/p'],
+                    ['Produto 6', 'Pagina Produto 6', site + 'produto_6/p']]
+        self.assertEqual(expected, self.load_result_csv())
+        # Resuming a finished crawl visits nothing
+        with patch('crawler.get_page_contents', MockPageGenerator(mock_params)):
+            crawler.main(['-w', '1', '-d', '2', '-o', 'teste.csv', '-r', 'teste.json', '/pagina_inicial'])
+        self.assertEqual(expected, self.load_result_csv())
+
+
+class TestAsyncioEngine(unittest.TestCase):
+    """Tests that the asyncio engine and every kind of pool worker write the same rows"""
+    mock_params = {
+        '/pagina_inicial': ('Pagina Inicial', 'Produto Inicial', 'produto_1/p', 'pagina_2', 'produto_3/p'),
+        '/produto_1/p': ('Pagina Produto 1', 'Produto 1', 'produto_3/p', 'pagina_5', 'pagina_6'),
+        '/produto_2/p': ('Pagina Produto 2', 'Produto 2', 'produto_4/p', 'produto_5/p', 'pagina_1'),
+        '/produto_3/p': ('Pagina Produto 3', 'Produto 3', 'produto_2/p', 'produto_4/p', 'produto_6/p'),
+        '/produto_4/p': ('Pagina Produto 4', 'Produto 4', 'pagina_inicial', 'pagina_6', 'produto_5/p'),
+        '/pagina_2': ('Pagina 2', 'Página 2', 'produto_2/p', 'pagina_1', 'pagina_3'),
+        '/pagina_5': ('Pagina 5', 'Página 5', 'produto_2/p', 'pagina_4', 'produto_4/p'),
+    }
+
+    def setUp(self):
+        if os.path.exists('teste.csv'):
+            os.remove('teste.csv')
+
+    def tearDown(self):
+        if os.path.exists('teste.csv'):
+            os.remove('teste.csv')
+
+    def load_result_csv(self):
+        with open('teste.csv') as csvfile:
+            csvreader = csv.reader(csvfile)
+            return [row for row in csvreader]
+
+    def test_same_rows_as_pool_engine(self):
+        with patch('crawler.get_page_contents', MockPageGenerator(self.mock_params)):
+            crawler.main(['-w', '1', '-d', '2', '-o', 'teste.csv', '/pagina_inicial'])
+        expected = self.load_result_csv()
+        with patch('crawler.fetch_page_async', AsyncMockPageGenerator(self.mock_params)):
+            crawler.main(['-d', '2', '-o', 'teste.csv', '-e', 'asyncio', '-c', '2', '--parsers', '2',
+                          '/pagina_inicial'])
+        self.assertEqual(4, len(expected))
+        self.assertCountEqual(expected, self.load_result_csv())
+
+    def test_same_rows_with_every_worker_kind(self):
+        with patch('crawler.get_page_contents', MockPageGenerator(self.mock_params)):
+            crawler.main(['-w', '1', '-d', '2', '-o', 'teste.csv', '/pagina_inicial'])
+            expected = self.load_result_csv()
+            for kind in ('thread', 'hybrid'):
+                crawler.main(['-w', '4', '--worker-kind', kind, '--parsers', '2', '-d', '2', '-o', 'teste.csv',
+                              '/pagina_inicial'])
+                self.assertCountEqual(expected, self.load_result_csv(), kind)
+
+
+
+class TestMockSite(unittest.TestCase):
+    """Crawls the local mock site over HTTP, through the whole HTTP stack of each engine"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.site = mock_site.MockSite(products=30, categories=3, fanout=4, removed_rate=0.2, error_rate=0.05, seed=3)
+        cls.server = cls.site.serve()
+        cls.products = [[name, '{} - Época Cosméticos'.format(name), url] for name, url in
+                        (('Produto {}'.format(n), '{}/produto-{}/p'.format(cls.server.base_url, n)) for n in range(30))]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def tearDown(self):
+        if os.path.exists('teste.csv'):
+            os.remove('teste.csv')
+
+    def load_result_csv(self):
+        with open('teste.csv') as csvfile:
+            return list(csv.reader(csvfile))
+
+    def test_every_engine_finds_every_product(self):
+        for engine_args in (['-w', '4', '--worker-kind', 'thread'], ['-e', 'asyncio', '-c', '4', '--parsers', '1']):
+            crawler.main(['--base-url', self.server.base_url, '-d', '20', '-o', 'teste.csv', '--retry-backoff', '0',
+                          '--retries', 'http=10'] + engine_args + ['/'])
+            self.assertCountEqual(self.products, self.load_result_csv(), engine_args)
+        # The crawler is pointed back at the real site once the crawl is over
+        self.assertEqual(crawler.DEFAULT_BASE_URL, crawler.BASE_URL)
+
+    def test_sitemap_over_http(self):
+        crawler.main(['--base-url', self.server.base_url, '-w', '2', '--worker-kind', 'thread', '-o', 'teste.csv',
+                      '--retry-backoff', '0', '--retries', 'http=10', '--sitemap'])
+        self.assertCountEqual(self.products, self.load_result_csv())
+
+    def test_prices_with_each_extractor(self):
+        for extractor in ('embedded', 'dom'):
+            crawler.main(['--base-url', self.server.base_url, '-w', '2', '--worker-kind', 'thread', '-o', 'teste.csv',
+                          '--retry-backoff', '0', '--retries', 'http=10', '--sitemap', '--prices',
+                          '--extractor', extractor])
+            rows = {row[2]: row for row in self.load_result_csv()}
+            self.assertEqual(['Produto 12', 'Produto 12 - Época Cosméticos', self.products[12][2], '12', '24.34',
+                              '34.34', 'True'], rows[self.products[12][2]], extractor)
+            self.assertEqual(['10', '23.6', '', 'False'], rows[self.products[10][2]][3:], extractor)
+
+    def test_schema(self):
+        schema = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'schemas', 'product.json')
+        crawler.main(['--base-url', self.server.base_url, '-e', 'asyncio', '-c', '4', '--parsers', '1', '-o',
+                      'teste.csv', '--retry-backoff', '0', '--retries', 'http=10', '--sitemap', '--schema', schema])
+        rows = {row[-1]: row for row in self.load_result_csv()}
+        self.assertEqual(30, len(rows))
+        self.assertEqual(['Produto 12', 'Produto 12 - Época Cosméticos', '', '12', '24.34', '34.34', 'True', '0',
+                          self.products[12][2]], rows[self.products[12][2]])
+
+    def test_incremental_crawl(self):
+        site = mock_site.MockSite(products=30, categories=3, fanout=4, removed_rate=0.2, seed=3)
+        server = site.serve()
+        product_data = site.product_data
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                changes = os.path.join(directory, 'changes.db')
+                for engine_args in (['-w', '2', '--worker-kind', 'thread'], ['-e', 'asyncio', '-c', '4',
+                                                                             '--parsers', '1']):
+                    args = ['--base-url', server.base_url, '-d', '20', '-o', 'teste.csv', '--incremental', changes,
+                            '--prices', '--log-level', 'WARNING'] + engine_args + ['/']
+                    crawler.main(args)
+                    self.assertEqual(30, len(self.load_result_csv()), engine_args)
+                    crawler.main(args)
+                    self.assertEqual([], self.load_result_csv(), engine_args)
+                    # Product 5 now has the price of product 6, and product 29 is gone
+                    site.products = 29
+                    site.product_data = lambda product, *args: product_data(product + (product == 5), *args)
+                    crawler.main(args)
+                    self.assertCountEqual([
+                        ['changed', 'Produto 5', 'Produto 5 - Época Cosméticos', server.base_url + '/produto-5/p',
+                         '6', '22.12', '32.12', 'True'],
+                        ['removed', 'Produto 29', 'Produto 29 - Época Cosméticos', server.base_url + '/produto-29/p',
+                         '29', '30.63', '', 'True']], self.load_result_csv(), engine_args)
+                    crawler.remove_database(changes)
+                    site.products = 30
+                    site.product_data = product_data
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def start_nodes(self, address, engines, **kwargs):
+        return [subprocess.Popen([sys.executable, CRAWLER_EXECUTABLE, '--join', address, '--base-url',
+                                  self.server.base_url, '-d', '20', '--retry-backoff', '0', '--retries', 'http=10',
+                                  '--log-level', 'WARNING'] + engine_args + ['/'], **kwargs)
+                for engine_args in engines]
+
+    def stop_nodes(self, nodes):
+        for node in nodes:
+            if node.poll() is None:
+                node.kill()
+                node.wait()
+
+    def test_distributed_crawl(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'crawl.sock')
+            nodes = self.start_nodes(address, (['-w', '2', '--worker-kind', 'thread'], ['-w', '2'],
+                                               ['-e', 'asyncio', '-c', '4', '--parsers', '1']))
+            try:
+                crawler.main(['--coordinator', address, '--nodes', '3', '-o', 'teste.csv'])
+                self.assertEqual([0, 0, 0], [node.wait(30) for node in nodes])
+            finally:
+                self.stop_nodes(nodes)
+        self.assertCountEqual(self.products, self.load_result_csv())
+
+    def test_lost_coordinator(self):
+        with tempfile.TemporaryDirectory() as directory:
+            address = 'unix:' + os.path.join(directory, 'crawl.sock')
+            nodes = self.start_nodes(address, (['-w', '2', '--worker-kind', 'thread'],), stdout=subprocess.PIPE,
+                                     universal_newlines=True)
+            try:
+                transport = crawler.listen_transport(address, 1, timeout=30)
+                transport.send({'type': 'welcome', 'node': 0, 'nodes': 2, 'fields': list(crawler.RESULT_FIELDS)}, 0)
+                transport.flush()
+                transport.close()
+                output = nodes[0].communicate(timeout=30)[0]
+                self.assertEqual(1, nodes[0].returncode)
+                self.assertIn('Lost the connection to the coordinator', output)
+            finally:
+                self.stop_nodes(nodes)
+                nodes[0].stdout.close()
+
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file